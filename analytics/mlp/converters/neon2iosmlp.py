@@ -1,43 +1,98 @@
 import numpy as np
+import collections
 import struct
+import json
+import zlib
 import cPickle as pkl
 
+# Single file model container. The file starts with the magic bytes followed by the little endian uint32 values
+# version, header length and data offset. The JSON header follows. The weight blocks start at the data offset, which
+# like the offset of every block is aligned to a page, so every block can be memory-mapped on its own.
+# Version 2 added quantized weights.
+Container_Magic = 'MUVRMLP\0'
+Container_Version = 2
+Container_Preamble = struct.Struct('<III')
+Page_Size = 4096
+
+# Storage types of the weights in a container
+Container_Dtypes = {'float32': '<f4', 'float16': '<f2', 'int8': 'i1'}
+
+# Layer of a quantized model: float32 biases and the weights, which approximate the original weights once multiplied
+# with the scale
+QuantizedLayer = collections.namedtuple('QuantizedLayer', ['biases', 'weights', 'scale'])
 
-def extract_weights(file_name):
-    """Load weights from the file_name. Data in the file should be stored neon model."""
 
-    vec = []
+def layer_params(file_name):
+    """Load the `(biases, weights)` of every layer from the file_name. Data in the file should be stored neon model.
+
+    Biases are an `(outputs, 1)` array, weights an `(outputs, inputs)` array."""
     # Load a stored model file from disk (should have extension prm)
     params = pkl.load(open(file_name, 'r'))
-
-    num_linear_layers = len(params["layer_params_states"])
+    states = params["layer_params_states"]
 
     # Neon layers are LinearLayer_0, BiasLayer_1, LinearLayer_4, ...
     # A linear layer is followed by a bias layer. We need to concat their weights
+    # Make sure our model has biases activated, otherwise add zeros here
+    return [(states[layer_idx + 1]['params']['W'], states[layer_idx]['params']['W'])
+            for layer_idx in range(0, len(states), 2)]
 
-    for layer_idx in range(0, num_linear_layers, 2):
-        # Make sure our model has biases activated, otherwise add zeros here
-        b = params["layer_params_states"][layer_idx + 1]['params']['W']
-        w = params["layer_params_states"][layer_idx]['params']['W']
 
-        layer_vector = np.ravel(np.hstack((b, w)))
-        [vec.append(nv) for nv in layer_vector]
-    return vec
+def extract_layers(file_name):
+    """Load the weights of every layer of the stored neon model as `(outputs, inputs + 1)` float32 matrix. The first
+    column of a matrix contains the biases, like the rows of the iOS model format."""
+    return [np.hstack((b, w)).astype(np.float32) for b, w in layer_params(file_name)]
+
+
+def extract_weights(file_name):
+    """Load weights from the file_name as one float32 vector in the order of the iOS model format."""
+    return np.concatenate([np.ravel(layer) for layer in extract_layers(file_name)])
 
 
 def model2string(neon_model_path):
     """Serialize the model at the path to a string representation."""
-    
-    weights = extract_weights(neon_model_path)
-    return struct.pack('f' * len(weights), *weights)
+    return extract_weights(neon_model_path).astype('<f4').tobytes()
+
 
-def convert(neon_model_path, output_filename):
-    """Convert the serialization of a neon model into an iOS MLP model."""
+def write_weights(params, f, chunk_rows=None):
+    """Write the `(biases, weights)` of the layers to the open file in the iOS model format.
 
+    If chunk rows is set, every layer is written in chunks of that many rows. Only one chunk gets converted at a time,
+    which keeps the memory needed for the conversion small, independent of the size of the model."""
+    for b, w in params:
+        rows = chunk_rows or len(w)
+        for start in range(0, len(w), rows):
+            chunk = np.hstack((b[start:start + rows], w[start:start + rows]))
+            f.write(chunk.astype('<f4').tobytes())
+
+
+def convert(neon_model_path, output_filename, chunk_rows=None):
+    """Convert the serialization of a neon model into an iOS MLP model. See `write_weights` for the chunk rows."""
     with open(output_filename, "wb") as f:
-        #  You can use 'd' for double and < or > to force endinness
-        model_as_string = model2string(neon_model_path)
-        f.write(model_as_string)
+        write_weights(layer_params(neon_model_path), f, chunk_rows)
+
+
+def read_weights(weights_filename, layers):
+    """Read an iOS MLP model. Returns the `(outputs, inputs + 1)` float32 matrix of every layer."""
+    weights = np.fromfile(weights_filename, dtype='<f4')
+    shapes = [(n_out, n_in + 1) for n_in, n_out in zip(layers[:-1], layers[1:])]
+    if len(weights) != sum(n_out * n_in for n_out, n_in in shapes):
+        raise Exception("Invalid weights for layer configuration")
+    offsets = np.cumsum([0] + [n_out * n_in for n_out, n_in in shapes])
+    return [weights[start:end].reshape(shape) for start, end, shape in zip(offsets[:-1], offsets[1:], shapes)]
+
+
+def verify_conversion(neon_model_path, weights_filename, layers_filename):
+    """Check the iOS MLP model against the neon model it got converted from. Returns `True` if the layer configuration
+    and all weights match."""
+    with open(layers_filename, 'r') as f:
+        layers = [int(size) for size in f.read().split()]
+    try:
+        converted = read_weights(weights_filename, layers)
+    except Exception:
+        return False
+    expected = extract_layers(neon_model_path)
+    return len(converted) == len(expected) and all(np.array_equal(c, e) for c, e in zip(converted, expected))
+
 
 def write_layers_to_file(layers, output_filename):
     """Write the layer configuration of a model to the output file."""
@@ -45,3 +100,144 @@ def write_layers_to_file(layers, output_filename):
     with open(output_filename, 'w') as f:
         data = " ".join(str(e) for e in layers)
         f.write(data)
+
+
+def page_aligned(offset):
+    return -(-offset // Page_Size) * Page_Size
+
+
+def quantize_layer(layer, dtype):
+    """Quantize the weights of the `(outputs, inputs + 1)` matrix of a layer to float16 or int8.
+
+    int8 weights are quantized symmetrically around 0 using one scale for the whole layer. Biases stay float32."""
+    biases = np.ascontiguousarray(layer[:, 0], dtype='<f4')
+    weights = layer[:, 1:]
+    if dtype == 'int8':
+        max_abs = float(np.abs(weights).max())
+        scale = max_abs / 127 if max_abs > 0 else 1.0
+        quantized = np.clip(np.round(weights / scale), -127, 127).astype('i1')
+    elif dtype == 'float16':
+        scale = 1.0
+        quantized = weights.astype('<f2')
+    else:
+        raise Exception("Unsupported quantization %s" % dtype)
+    return QuantizedLayer(biases, quantized, scale)
+
+
+def write_container(layer_weights, labels, output_filename, hidden_activation='relu', output_activation='sigmoid',
+                    bias_value=1.0, dtype='float32'):
+    """Write the model into a single container file. Layer weights are the `(outputs, inputs + 1)` matrices returned
+    by `extract_layers`. The activations and bias value describe how the iOS app propagates the features.
+
+    Weights are stored as float32 or quantized to float16 or int8, see `quantize_layer`."""
+    layers = [layer_weights[0].shape[1] - 1] + [w.shape[0] for w in layer_weights]
+
+    # Every float32 layer is a single block. Quantized layers are stored as block of weights followed by a block of
+    # biases.
+    blocks = []
+    block_entries = []
+    offset = 0
+    for w in layer_weights:
+        if dtype == 'float32':
+            block = np.ascontiguousarray(w, dtype='<f4')
+            block_entries.append({'offset': offset, 'shape': list(block.shape)})
+            blocks.append(block)
+        else:
+            quantized = quantize_layer(w, dtype)
+            block = np.ascontiguousarray(quantized.weights)
+            bias_offset = page_aligned(offset + block.nbytes)
+            block_entries.append({'offset': offset, 'shape': list(block.shape), 'scale': quantized.scale,
+                                  'bias_offset': bias_offset})
+            blocks += [block, quantized.biases]
+            offset = bias_offset
+        offset = page_aligned(offset + blocks[-1].nbytes)
+
+    checksum = 0
+    for block in blocks:
+        checksum = zlib.crc32(block.tostring(), checksum)
+
+    header = json.dumps({
+        'byte_order': 'little',
+        'dtype': dtype,
+        'layers': layers,
+        'activations': {'hidden': hidden_activation, 'output': output_activation},
+        'bias_value': bias_value,
+        'labels': list(labels),
+        'blocks': block_entries,
+        'checksum': checksum & 0xffffffff
+    }, sort_keys=True)
+    data_offset = page_aligned(len(Container_Magic) + Container_Preamble.size + len(header))
+
+    block_offsets = []
+    for entry in block_entries:
+        block_offsets.append(entry['offset'])
+        if 'bias_offset' in entry:
+            block_offsets.append(entry['bias_offset'])
+
+    with open(output_filename, 'wb') as f:
+        f.write(Container_Magic)
+        f.write(Container_Preamble.pack(Container_Version, len(header), data_offset))
+        f.write(header)
+        for offset, block in zip(block_offsets, blocks):
+            f.seek(data_offset + offset)
+            f.write(block.tostring())
+
+
+def read_container(filename, verify=True):
+    """Read a container written by `write_container`. Returns the header and the weights of all layers.
+
+    The weights of a float32 container are the `(outputs, inputs + 1)` matrices of the layers, those of a quantized
+    container are `QuantizedLayer`s. All arrays are views into the memory-mapped file, nothing gets copied. Verifying
+    the checksum reads all weights once."""
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    start = len(Container_Magic)
+    if data[:start].tostring() != Container_Magic:
+        raise Exception("Bad format")
+    version, header_length, data_offset = Container_Preamble.unpack(data[start:start + Container_Preamble.size])
+    if version > Container_Version:
+        raise Exception("Unsupported container version %d" % version)
+    start += Container_Preamble.size
+    header = json.loads(data[start:start + header_length].tostring())
+    if header['byte_order'] != 'little' or header['dtype'] not in Container_Dtypes:
+        raise Exception("Bad format")
+    dtype = np.dtype(Container_Dtypes[header['dtype']])
+
+    def block(offset, shape, block_dtype):
+        nbytes = block_dtype.itemsize * int(np.prod(shape))
+        return data[data_offset + offset:data_offset + offset + nbytes]
+
+    layer_weights = []
+    checksum = 0
+    for entry in header['blocks']:
+        weights = block(entry['offset'], entry['shape'], dtype)
+        if verify:
+            checksum = zlib.crc32(weights, checksum)
+        weights = weights.view(dtype).reshape(entry['shape'])
+        if header['dtype'] == 'float32':
+            layer_weights.append(weights)
+        else:
+            biases = block(entry['bias_offset'], entry['shape'][:1], np.dtype('<f4'))
+            if verify:
+                checksum = zlib.crc32(biases, checksum)
+            layer_weights.append(QuantizedLayer(biases.view('<f4'), weights, entry['scale']))
+    if verify and checksum & 0xffffffff != header['checksum']:
+        raise Exception("Checksum mismatch, the model in %s is corrupt" % filename)
+    return header, layer_weights
+
+
+def export(neon_model_path, layers, labels, output_prefix, container=True, legacy=True, dtype='float32'):
+    """Export the neon model as `<output_prefix>.mlp` container and / or the legacy `<output_prefix>.labels.txt`,
+    `<output_prefix>.layers.txt` and `<output_prefix>.weights.raw` files the iOS app reads.
+
+    The dtype only applies to the container, the legacy files always contain float32 weights."""
+    if container:
+        layer_weights = extract_layers(neon_model_path)
+        if [layer_weights[0].shape[1] - 1] + [w.shape[0] for w in layer_weights] != list(layers):
+            raise Exception("Layer configuration does not match the weights of the model")
+        write_container(layer_weights, labels, output_prefix + '.mlp', dtype=dtype)
+    if legacy:
+        with open(output_prefix + '.labels.txt', 'wb') as f:
+            for label in labels:
+                f.write("%s\n" % label)
+        convert(neon_model_path, output_prefix + '.weights.raw')
+        write_layers_to_file(layers, output_prefix + '.layers.txt')
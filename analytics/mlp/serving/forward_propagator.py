@@ -0,0 +1,231 @@
+"""Batch inference of MLP models exported by `converters.neon2iosmlp`, using nothing but numpy."""
+
+import numpy as np
+from converters import neon2iosmlp
+
+
+def relu(x):
+    np.maximum(x, 0, out=x)
+
+
+def sigmoid(x):
+    # 1 / (1 + exp(-x)). Large negative inputs overflow exp to inf, which correctly results in 0
+    with np.errstate(over='ignore'):
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        np.reciprocal(x, out=x)
+
+
+def tanh(x):
+    np.tanh(x, out=x)
+
+
+def identity(x):
+    pass
+
+
+# Activation functions supported by the iOS app. They modify the passed activations in place.
+Activations = {
+    'relu': relu,
+    'sigmoid': sigmoid,
+    'tanh': tanh,
+    'identity': identity
+}
+
+
+def load_layers(filename):
+    """Load the layer configuration written by `neon2iosmlp.write_layers_to_file`, e.g. `[1200, 250, 100, 3]`."""
+    with open(filename, 'r') as f:
+        return [int(size) for size in f.read().split()]
+
+
+def load_labels(filename):
+    """Load the labels written by `AccelerationDataset.save_labels`. The id of a label is its line number."""
+    with open(filename, 'r') as f:
+        return f.read().splitlines()
+
+
+def load_weights(filename, mmap=False):
+    """Load the weights written by `neon2iosmlp.convert` as one float32 vector. If mmap is set the file gets
+    memory-mapped instead of read."""
+    if mmap:
+        return np.memmap(filename, dtype='<f4', mode='r')
+    else:
+        return np.fromfile(filename, dtype='<f4')
+
+
+class ForwardPropagator(object):
+    """Forward propagation of an exported MLP model over batches of feature vectors.
+
+    Works like the `MKForwardPropagator` of the iOS app, to get the same predictions the phone produces: the weights of
+    each layer form a `(outputs, inputs + 1)` matrix whose first column is multiplied with the bias value. Hidden layers
+    use the hidden activation, the last layer the output activation.
+
+    Features are propagated in chunks of at most `batch_size` examples. The activations of every layer are stored in
+    buffers which get allocated once and are reused for every chunk."""
+
+    Default_Batch_Size = 1024
+
+    def __init__(self, layers, weights, hidden_activation='relu', output_activation='sigmoid', bias_value=1.0,
+                 batch_size=Default_Batch_Size, keep_quantized=False):
+        """Layers is the number of units per layer. Weights are either the flat vector of all weights or a list of
+        the weights of the layers, each either an `(outputs, inputs + 1)` matrix or a `neon2iosmlp.QuantizedLayer`.
+        Activations are either names of the `Activations` or functions modifying the activations in place.
+
+        Quantized weights are converted to float32 once, when the model is created. If keep_quantized is set, only
+        the quantized weights are kept in memory instead, and they get converted for every batch."""
+        shapes = [(n_out, n_in + 1) for n_in, n_out in zip(layers[:-1], layers[1:])]
+        if isinstance(weights, list):
+            valid = [self.layer_shape(w) for w in weights] == shapes
+        else:
+            valid = len(weights) == sum(n_out * n_in for n_out, n_in in shapes)
+        if len(layers) < 2 or not valid:
+            raise Exception("Invalid weights for layer configuration")
+
+        self.layers = list(layers)
+        self.hidden_activation = Activations.get(hidden_activation, hidden_activation)
+        self.output_activation = Activations.get(output_activation, output_activation)
+        self.batch_size = batch_size
+
+        # The weight matrices are views into the weights, which may be memory-mapped. Only the scaled biases get copied.
+        self.weights = []
+        self.scales = []
+        self.biases = []
+        offset = 0
+        for i, shape in enumerate(shapes):
+            if isinstance(weights, list) and isinstance(weights[i], neon2iosmlp.QuantizedLayer):
+                biases, matrix, scale = weights[i]
+                if keep_quantized:
+                    self.weights.append(matrix.T)
+                    self.scales.append(scale)
+                else:
+                    self.weights.append(np.multiply(matrix.T, scale, dtype=np.float32))
+                    self.scales.append(1.0)
+            else:
+                if isinstance(weights, list):
+                    matrix = np.asarray(weights[i])
+                else:
+                    matrix = np.asarray(weights[offset:offset + shape[0] * shape[1]]).reshape(shape)
+                    offset += shape[0] * shape[1]
+                biases = matrix[:, 0]
+                self.weights.append(matrix[:, 1:].T)
+                self.scales.append(1.0)
+            self.biases.append(np.asarray(biases * bias_value, dtype=np.float32))
+
+        self.buffers = [np.empty((batch_size, n_out), dtype=np.float32) for n_out in layers[1:]]
+
+        # Quantized weights that are kept get converted to float32 in this buffer right before they are used, which
+        # allows BLAS to do the multiplication while only the quantized weights are kept in memory
+        quantized_sizes = [w.size for w in self.weights if w.dtype != np.float32]
+        self.dequantized = np.empty(max(quantized_sizes), dtype=np.float32) if quantized_sizes else None
+
+    @staticmethod
+    def layer_shape(layer_weights):
+        if isinstance(layer_weights, neon2iosmlp.QuantizedLayer):
+            n_out, n_in = np.shape(layer_weights.weights)
+            return n_out, n_in + 1
+        else:
+            return np.shape(layer_weights)
+
+    @classmethod
+    def from_files(cls, layers_filename, weights_filename, mmap=False, **kwargs):
+        """Load an exported model, e.g. `arms_model.layers.txt` and `arms_model.weights.raw`."""
+        return cls(load_layers(layers_filename), load_weights(weights_filename, mmap), **kwargs)
+
+    @classmethod
+    def from_container(cls, filename, verify=True, **kwargs):
+        """Load a model container written by `neon2iosmlp.write_container`. The weights stay memory-mapped."""
+        header, layer_weights = neon2iosmlp.read_container(filename, verify)
+        return cls.from_header(header, layer_weights, **kwargs)
+
+    @classmethod
+    def from_header(cls, header, layer_weights, **kwargs):
+        """Create the propagator for a container read by `neon2iosmlp.read_container`. Unless passed explicitly, the
+        activations and bias value stored in the container are used."""
+        kwargs.setdefault('hidden_activation', header['activations']['hidden'])
+        kwargs.setdefault('output_activation', header['activations']['output'])
+        kwargs.setdefault('bias_value', header['bias_value'])
+        return cls(header['layers'], layer_weights, **kwargs)
+
+    @property
+    def num_features(self):
+        return self.layers[0]
+
+    @property
+    def num_outputs(self):
+        return self.layers[-1]
+
+    def propagate_batch(self, x):
+        """Propagate one batch of at most `batch_size` feature vectors. Returns a view into the output buffer, which
+        gets overwritten by the next batch."""
+        n = x.shape[0]
+        num_layers = len(self.weights)
+        for i in range(num_layers):
+            out = self.buffers[i][:n]
+            weights = self.weights[i]
+            if weights.dtype != np.float32:
+                dequantized = self.dequantized[:weights.size].reshape(weights.shape)
+                np.copyto(dequantized, weights)
+                weights = dequantized
+            np.dot(x, weights, out=out)
+            if self.scales[i] != 1.0:
+                out *= self.scales[i]
+            out += self.biases[i]
+            if i == num_layers - 1:
+                self.output_activation(out)
+            else:
+                self.hidden_activation(out)
+            x = out
+        return x
+
+    def predict(self, features, out=None):
+        """Predict the outputs for all feature vectors.
+
+        Features should be an `(N, num_features)` array, e.g. windows flattened using `AccelerationDataset.flatten2d`,
+        or any array whose examples flatten to `num_features` values. Returns an `(N, num_outputs)` array."""
+        features = np.asarray(features)
+        features = features.reshape((features.shape[0], -1))
+        if features.shape[1] != self.num_features:
+            raise Exception("Invalid feature matrix size")
+
+        if out is None:
+            out = np.empty((features.shape[0], self.num_outputs), dtype=np.float32)
+        for start in range(0, features.shape[0], self.batch_size):
+            x = np.asarray(features[start:start + self.batch_size], dtype=np.float32)
+            out[start:start + x.shape[0]] = self.propagate_batch(x)
+        return out
+
+    def predict_labels(self, features):
+        """Label ids of the most likely labels of all feature vectors."""
+        return np.argmax(self.predict(features), axis=1)
+
+
+def accuracy_delta(reference, other, examples, chunk_size=ForwardPropagator.Default_Batch_Size):
+    """Compare the predictions of two propagators, e.g. of a float32 and a quantized model, on the examples.
+
+    Examples are an example collection, e.g. the test examples of an `AccelerationDataset`. They are propagated in
+    chunks, so windows of a lazily augmented collection only get materialized one chunk at a time."""
+    num_examples = examples.num_examples
+    labels = np.asarray(examples.labels)
+    correct = np.zeros(2, dtype=int)
+    agreeing = 0
+    max_difference = 0.0
+    for start in range(0, num_examples, chunk_size):
+        positions = np.arange(start, min(start + chunk_size, num_examples))
+        features = examples.take(positions)
+        predictions = [reference.predict(features), other.predict(features)]
+        predicted = [np.argmax(p, axis=1) for p in predictions]
+        correct += [np.sum(p == labels[positions]) for p in predicted]
+        agreeing += np.sum(predicted[0] == predicted[1])
+        max_difference = max(max_difference, float(np.abs(predictions[0] - predictions[1]).max()))
+
+    accuracy = correct / float(max(num_examples, 1))
+    return {
+        'examples': num_examples,
+        'reference_accuracy': accuracy[0],
+        'accuracy': accuracy[1],
+        'accuracy_delta': accuracy[1] - accuracy[0],
+        'agreement': agreeing / float(max(num_examples, 1)),
+        'max_probability_difference': max_difference
+    }
@@ -0,0 +1,118 @@
+"""Registry of the exported models available to a serving process."""
+
+import collections
+import logging
+import os
+import threading
+import numpy as np
+from converters import neon2iosmlp
+from serving.forward_propagator import ForwardPropagator, load_labels
+
+# A loaded model together with the labels of its outputs. The buffers of the propagator are guarded by the lock.
+LoadedModel = collections.namedtuple('LoadedModel', ['propagator', 'labels', 'lock'])
+
+
+class ModelRegistry(object):
+    """Discovers exported models and loads them on demand.
+
+    A model is either a `<name>_model.mlp` container or consists of the files `<name>_model.labels.txt`,
+    `<name>_model.layers.txt` and `<name>_model.weights.raw`, as shipped in `ios/Muvr/Models.bundle`. Containers are
+    preferred if both exist. Models get loaded the first time they
+    are used, with their weights memory-mapped. Only the `max_models` most recently used models are kept loaded."""
+    logger = logging.getLogger("serving.ModelRegistry")
+
+    Model_Suffix = '_model'
+    Container_Suffix = '.mlp'
+    Labels_Suffix = '.labels.txt'
+    Layers_Suffix = '.layers.txt'
+    Weights_Suffix = '.weights.raw'
+
+    def __init__(self, directories, max_models=8, **propagator_args):
+        """Models are searched in the directories and their subdirectories. The propagator args are passed to every
+        `ForwardPropagator`, e.g. its activations."""
+        self.directories = directories
+        self.max_models = max_models
+        self.propagator_args = propagator_args
+        self.prefixes = {}
+        self.loaded = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.discover()
+
+    def discover(self):
+        """Search the directories for models. Loaded models stay loaded. Returns the names of all known models."""
+        prefixes = {}
+        for directory in self.directories:
+            for root, _, names in os.walk(directory):
+                for name in sorted(names):
+                    if name.endswith(self.Model_Suffix + self.Container_Suffix):
+                        suffix = self.Container_Suffix
+                    elif name.endswith(self.Model_Suffix + self.Layers_Suffix):
+                        suffix = self.Layers_Suffix
+                    else:
+                        continue
+                    prefix = os.path.join(root, name[:-len(suffix)])
+                    if suffix == self.Layers_Suffix:
+                        if os.path.isfile(prefix + self.Container_Suffix):
+                            continue
+                        if not all(os.path.isfile(prefix + s) for s in [self.Labels_Suffix, self.Weights_Suffix]):
+                            self.logger.warn("Ignoring incomplete model %s" % prefix)
+                            continue
+                    model_name = name[:-len(self.Model_Suffix + suffix)]
+                    if model_name in prefixes:
+                        self.logger.warn("Model %s found in %s and %s, using the first one" %
+                                         (model_name, prefixes[model_name], prefix))
+                        continue
+                    prefixes[model_name] = prefix
+
+        with self.lock:
+            self.prefixes = prefixes
+        return self.model_names()
+
+    def model_names(self):
+        return sorted(self.prefixes.keys())
+
+    def load(self, model_name):
+        if model_name not in self.prefixes:
+            raise Exception("Unknown model %s" % model_name)
+        prefix = self.prefixes[model_name]
+        self.logger.info("Loading model %s from %s" % (model_name, prefix))
+        if os.path.isfile(prefix + self.Container_Suffix):
+            header, layer_weights = neon2iosmlp.read_container(prefix + self.Container_Suffix)
+            propagator = ForwardPropagator.from_header(header, layer_weights, **self.propagator_args)
+            labels = header['labels']
+        else:
+            propagator = ForwardPropagator.from_files(prefix + self.Layers_Suffix, prefix + self.Weights_Suffix,
+                                                      mmap=True, **self.propagator_args)
+            labels = load_labels(prefix + self.Labels_Suffix)
+        if len(labels) != propagator.num_outputs:
+            raise Exception("Model %s has %d outputs but %d labels" % (model_name, propagator.num_outputs, len(labels)))
+        return LoadedModel(propagator, labels, threading.Lock())
+
+    def model(self, model_name):
+        """The loaded model. Loads it if necessary and unloads the least recently used model if too many are loaded."""
+        with self.lock:
+            if model_name in self.loaded:
+                model = self.loaded.pop(model_name)
+            else:
+                model = self.load(model_name)
+                while len(self.loaded) >= self.max_models:
+                    evicted, _ = self.loaded.popitem(last=False)
+                    self.logger.info("Unloading model %s" % evicted)
+            self.loaded[model_name] = model
+            return model
+
+    def labels(self, model_name):
+        return self.model(model_name).labels
+
+    def classify(self, model_name, windows):
+        """Probabilities of the labels of the model for every window, as `(len(windows), number of labels)` array.
+
+        Windows should be flattened like `AccelerationDataset.flatten2d` does, or an `(N, 3, window length)` array. A
+        single `(3, window length)` window is classified as a batch of one window."""
+        model = self.model(model_name)
+        windows = np.asarray(windows)
+        num_features = model.propagator.num_features
+        if windows.ndim == 2 and windows.size == num_features and windows.shape[1] != num_features:
+            windows = windows[np.newaxis]
+        with model.lock:
+            return model.propagator.predict(windows)
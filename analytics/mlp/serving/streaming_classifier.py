@@ -0,0 +1,229 @@
+"""Classification of live accelerometer streams using sliding windows over the most recent samples of every device."""
+
+import asyncore
+import collections
+import logging
+import socket
+import time
+import numpy as np
+
+
+class RingBuffer(object):
+    """Holds the most recent `window_length` samples of a `dimensions` dimensional signal.
+
+    Every sample is stored twice, `window_length` samples apart. The current window is therefore always one contiguous
+    `(dimensions, window_length)` slice of the buffer and never needs to be reassembled."""
+
+    def __init__(self, window_length, dimensions=3, dtype=np.float32):
+        self.window_length = window_length
+        self.buffer = np.zeros((dimensions, 2 * window_length), dtype=dtype)
+        self.num_samples = 0
+
+    def append(self, samples):
+        """Append an `(N, dimensions)` array of samples, oldest first."""
+        samples = samples[-self.window_length:]
+        skipped = self.num_samples + max(len(samples) - self.window_length, 0)
+        positions = (skipped + np.arange(len(samples))) % self.window_length
+        self.buffer[:, positions] = samples.T
+        self.buffer[:, positions + self.window_length] = samples.T
+        self.num_samples = skipped + len(samples)
+
+    def window(self):
+        """View of the `window_length` most recent samples, oldest first."""
+        start = self.num_samples % self.window_length
+        return self.buffer[:, start:start + self.window_length]
+
+
+class ClassificationStats(object):
+    """Latency and throughput of the classification.
+
+    The latency of a window is the time between the arrival of its last sample and the prediction being available."""
+
+    def __init__(self, history=10000):
+        self.started = time.time()
+        self.num_windows = 0
+        self.num_batches = 0
+        self.latencies = collections.deque(maxlen=history)
+
+    def record(self, latencies):
+        self.num_windows += len(latencies)
+        self.num_batches += 1
+        self.latencies.extend(latencies)
+
+    def report(self):
+        """Summary of the windows classified so far, latencies are in milliseconds over the most recent windows."""
+        elapsed = time.time() - self.started
+        latencies = np.asarray(self.latencies) * 1000.0
+        summary = {
+            'windows': self.num_windows,
+            'batches': self.num_batches,
+            'windows_per_second': self.num_windows / elapsed if elapsed > 0 else 0.0,
+            'mean_batch_size': float(self.num_windows) / self.num_batches if self.num_batches > 0 else 0.0
+        }
+        if len(latencies) > 0:
+            summary['latency_mean_ms'] = latencies.mean()
+            summary['latency_p50_ms'] = np.percentile(latencies, 50)
+            summary['latency_p99_ms'] = np.percentile(latencies, 99)
+            summary['latency_max_ms'] = latencies.max()
+        return summary
+
+
+class StreamingClassifier(object):
+    """Classifies sliding windows of the sample streams of many devices.
+
+    Every device gets its own ring buffer. Once a device received a full window, a new window is classified every
+    `hop` samples, like `MKClassifier` steps over a recording. Windows of all devices are collected into one feature
+    matrix and classified together with a single forward pass, either when `flush` gets called or when `batch_size`
+    windows are waiting. Windows are flattened to the layout `AccelerationDataset.flatten2d` produces: all X values,
+    then all Y and Z values.
+
+    Predictions are passed to `on_prediction(device, num_samples, probabilities)`, where `num_samples` is the number of
+    samples the device received when the window was complete."""
+    logger = logging.getLogger("serving.StreamingClassifier")
+
+    Window_Length = 400
+    Hop = 10
+
+    def __init__(self, propagator, on_prediction, window_length=Window_Length, hop=Hop, dimensions=3, batch_size=256):
+        """The propagator is a `ForwardPropagator` expecting `dimensions * window_length` features."""
+        if propagator.num_features != dimensions * window_length:
+            raise Exception("Model expects %d features, windows have %d" %
+                            (propagator.num_features, dimensions * window_length))
+        self.propagator = propagator
+        self.on_prediction = on_prediction
+        self.window_length = window_length
+        self.hop = hop
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.stats = ClassificationStats()
+
+        # device -> (ring buffer, number of samples at which the next window is complete)
+        self.devices = {}
+
+        # Windows waiting to be classified, their devices, sample counts and completion times
+        self.pending = np.empty((batch_size, dimensions * window_length), dtype=np.float32)
+        self.pending_windows = []
+
+    def add_samples(self, device, samples):
+        """Add an `(N, dimensions)` array of samples, oldest first, received from the device."""
+        samples = np.asarray(samples, dtype=np.float32).reshape((-1, self.dimensions))
+        if device not in self.devices:
+            self.devices[device] = (RingBuffer(self.window_length, self.dimensions), self.window_length)
+        ring, next_window = self.devices[device]
+
+        received = time.time()
+        # Append the samples up to the end of each window that gets completed by them
+        start = 0
+        while start < len(samples):
+            end = min(len(samples), start + next_window - ring.num_samples)
+            ring.append(samples[start:end])
+            start = end
+            if ring.num_samples == next_window:
+                self.enqueue(device, ring, received)
+                next_window += self.hop
+        self.devices[device] = (ring, next_window)
+
+    def remove_device(self, device):
+        """Forget the samples of a device, e.g. after it disconnected. Its pending windows still get classified."""
+        self.devices.pop(device, None)
+
+    def enqueue(self, device, ring, received):
+        self.pending[len(self.pending_windows)] = ring.window().reshape(-1)
+        self.pending_windows.append((device, ring.num_samples, received))
+        if len(self.pending_windows) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Classify all pending windows with one forward pass. Returns the number of classified windows."""
+        num_windows = len(self.pending_windows)
+        if num_windows == 0:
+            return 0
+        probabilities = self.propagator.predict(self.pending[:num_windows])
+        done = time.time()
+
+        windows = self.pending_windows
+        self.pending_windows = []
+        self.stats.record([done - received for _, _, received in windows])
+        for (device, num_samples, _), p in zip(windows, probabilities):
+            self.on_prediction(device, num_samples, p)
+        return num_windows
+
+
+class SampleHandler(asyncore.dispatcher_with_send):
+    """Connection of a single device. Receives newline-delimited `x,y,z` samples and answers every classified window
+    with a line `<number of samples>,<most likely label>,<probability of every label>`."""
+    logger = logging.getLogger("serving.SampleHandler")
+
+    Read_Size = 65536
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher_with_send.__init__(self, sock)
+        self.server = server
+        self.incomplete = ''
+
+    def handle_read(self):
+        data = self.recv(self.Read_Size)
+        if not data:
+            return
+        # Only parse complete lines, the rest is kept until more data arrives
+        data = self.incomplete + data
+        end = data.rfind('\n') + 1
+        self.incomplete = data[end:]
+        lines = [line.strip() for line in data[:end].split('\n')]
+        lines = [line for line in lines if line]
+        if not lines:
+            return
+        samples = np.fromstring(",".join(lines), dtype=np.float32, sep=',')
+        if samples.size != 3 * len(lines):
+            self.logger.warn("Closing connection %s that sent samples in a bad format" % str(self.addr))
+            self.handle_close()
+            return
+        self.server.classifier.add_samples(self, samples)
+
+    def send_prediction(self, num_samples, probabilities):
+        label = self.server.labels[np.argmax(probabilities)]
+        self.send("%d,%s,%s\n" % (num_samples, label, ",".join("%.6f" % p for p in probabilities)))
+
+    def handle_close(self):
+        self.server.classifier.remove_device(self)
+        self.close()
+
+
+class StreamingServer(asyncore.dispatcher):
+    """Accepts devices streaming samples on a local socket. Windows of all devices that got completed while handling
+    the same round of socket events are classified together."""
+    logger = logging.getLogger("serving.StreamingServer")
+
+    def __init__(self, propagator, labels, host='127.0.0.1', port=9999, window_length=StreamingClassifier.Window_Length,
+                 hop=StreamingClassifier.Hop, batch_size=256):
+        asyncore.dispatcher.__init__(self)
+        self.labels = labels
+        self.classifier = StreamingClassifier(propagator, self.send_prediction, window_length, hop,
+                                              batch_size=batch_size)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+    @staticmethod
+    def send_prediction(handler, num_samples, probabilities):
+        if handler.connected:
+            handler.send_prediction(num_samples, probabilities)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            self.logger.info("Device connected from %s" % str(addr))
+            SampleHandler(sock, self)
+
+    def serve_forever(self, poll_timeout=0.01, report_interval=60):
+        """Handle socket events and classify the completed windows after every round of events. The statistics of
+        the classification get logged every `report_interval` seconds."""
+        last_report = time.time()
+        while True:
+            asyncore.loop(timeout=poll_timeout, count=1)
+            self.classifier.flush()
+            if time.time() - last_report >= report_interval:
+                self.logger.info("Classification stats: %s" % self.classifier.stats.report())
+                last_report = time.time()
@@ -6,7 +6,7 @@ except ImportError:
 setup(
     name='muvr-analysis-mlp',
     version='1.0-SNAPSHOT',
-    packages=['converters', 'training'],
+    packages=['converters', 'serving', 'training'],
     url='https://github.com/muvr/muvr-analytics',
     license='',
     author='Tom Bocklisch',
@@ -1,14 +1,19 @@
 import sys
-from pyspark import SparkContext, SparkConf
+import argparse
+import multiprocessing
 import os
 from converters import neon2iosmlp
 from training.acceleration_dataset import CSVAccelerationDataset
 from training.mlp_model import MLPMeasurementModelTrainer
+from training import utils
 from itertools import groupby
 from operator import attrgetter
 import uuid
 import shutil
 
+# Memory a worker of the local backend needs to train a model on the dataset of a single muscle group
+Memory_Per_Worker = 1 << 30
+
 def run_training_on(dataset, working_directory):
     """Create a fresh trainer to train a model on the dataset.
     
@@ -27,14 +32,14 @@ def run_training_on(dataset, working_directory):
     return str_model, layer_config, labels 
 
 
-def train_model_for_directory(dataset_directory):
-    """"Train a model for the dataset directory."""
+def train_model_for_directory(dataset_directory, working_directory=None):
+    """"Train a model for the dataset directory. By default the model is stored in the configured working directory."""
     
     model_name = os.path.basename(dataset_directory)
 
     print "Training model '{0}'\n".format(model_name)
 
-    working_directory = os.path.join(conf["working_directory"], model_name)
+    working_directory = os.path.join(working_directory or conf["working_directory"], model_name)
 
     # Load csv files into the dataset
     dataset = CSVAccelerationDataset(dataset_directory)
@@ -50,19 +55,60 @@ def train_model_for_directory(dataset_directory):
     }
 
 
+def train_locally(dataset_directory, working_directory, processes=None, blas_threads=1):
+    """Train a model for every muscle group directory in the dataset directory, using a pool of local processes.
+
+    Every worker limits BLAS to the given number of threads. If the number of processes is not passed, the pool is
+    sized by `utils.local_pool_size`. Returns the model records in the order of the directories."""
+    directories = sorted(os.path.join(dataset_directory, name) for name in os.listdir(dataset_directory)
+                         if os.path.isdir(os.path.join(dataset_directory, name)))
+    if not directories:
+        return []
+    processes = processes or utils.local_pool_size(len(directories), blas_threads, Memory_Per_Worker)
+    print "Training {0} models using {1} processes\n".format(len(directories), processes)
+
+    # Every process trains a single model. This gives every model a fresh neon backend and returns the memory of
+    # a finished training to the system.
+    pool = multiprocessing.Pool(processes, utils.limit_blas_threads, (blas_threads,), maxtasksperchild=1)
+    try:
+        results = [pool.apply_async(train_model_for_directory, (d, working_directory)) for d in directories]
+        return [result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+
 def main(sc):
     """Main entry point. Connects to cassandra and creates a spark job to start training."""
   
     # implement the magic!
 
 
+def main_local(processes, blas_threads):
+    """Entry point of the local backend. Trains all models using a process pool instead of spark."""
+    models = train_locally(conf["dataset_directory"], conf["working_directory"], processes, blas_threads)
+    for model in models:
+        print "Trained model '{0}' with layers {1} and labels {2}".format(model["model_name"], model["layers"],
+                                                                       model["labels"])
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train a model for every muscle group of the dataset.')
+    parser.add_argument('-b', metavar='backend', default='spark', choices=['spark', 'local'], help="run on spark or in a local process pool")
+    parser.add_argument('-p', metavar='processes', type=int, help="number of local processes, by default sized by cores and memory")
+    parser.add_argument('-t', metavar='threads', default=1, type=int, help="number of BLAS threads of every local process")
+    args = parser.parse_args()
 
     conf = {
         "dataset_directory": os.path.abspath("../../training-data/labelled"),
         "working_directory": os.path.abspath("../output")
     }
 
+    if args.b == 'local':
+        sys.exit(main_local(args.p, args.t))
+
+    from pyspark import SparkContext, SparkConf
+
     spark_configuration = SparkConf() \
         .setAppName("Muvr python spark training")
 
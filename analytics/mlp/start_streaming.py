@@ -0,0 +1,37 @@
+import sys
+import argparse
+import logging
+from serving.forward_propagator import ForwardPropagator, load_labels
+from serving.streaming_classifier import StreamingServer, StreamingClassifier
+from training.utils import limit_blas_threads
+
+
+def main(model_prefix, host, port, hop, batch_size, blas_threads):
+    """Main entry point."""
+    logging.basicConfig(level=logging.INFO)
+    limit_blas_threads(blas_threads)
+
+    propagator = ForwardPropagator.from_files(model_prefix + '.layers.txt', model_prefix + '.weights.raw',
+                                              batch_size=batch_size)
+    labels = load_labels(model_prefix + '.labels.txt')
+    server = StreamingServer(propagator, labels, host, port, hop=hop, batch_size=batch_size)
+
+    print "Classifying streams on %s:%d using %s" % (host, port, model_prefix)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    """List arguments for this program"""
+    parser = argparse.ArgumentParser(description='Classify live accelerometer streams sent to a local socket.')
+    parser.add_argument('-m', metavar='model', type=str, help="path prefix of the model files, e.g. ../output/arms_model")
+    parser.add_argument('-a', metavar='address', default='127.0.0.1', type=str, help="address to listen on")
+    parser.add_argument('-p', metavar='port', default=9999, type=int, help="port to listen on")
+    parser.add_argument('-s', metavar='hop', default=StreamingClassifier.Hop, type=int, help="number of samples between classified windows")
+    parser.add_argument('-b', metavar='batchsize', default=256, type=int, help="maximal number of windows classified together")
+    parser.add_argument('-t', metavar='threads', default=1, type=int, help="number of BLAS threads")
+    args = parser.parse_args()
+
+    #
+    # Devices connect and send one `x,y,z` sample per line, e.g.
+    # -m ../../ios/Muvr/Models.bundle/arms_model -p 9999
+    #
+    sys.exit(main(args.m, args.a, args.p, args.s, args.b, args.t))
@@ -0,0 +1,42 @@
+import sys
+import argparse
+from training.acceleration_dataset import CSVAccelerationDataset
+from training import sweep
+
+
+def parse_list(values, value_type):
+    return [value_type(v) for v in values.split(',')]
+
+
+def main(dataset_directory, working_directory, cache_directory, lrates, batch_sizes, max_epochs, processes,
+         blas_threads, patience):
+    """Main entry point."""
+
+    # The dataset is loaded and augmented once and then shared by all trials
+    dataset = CSVAccelerationDataset(dataset_directory, cache_directory=cache_directory, lazy_augmentation=True)
+    print "Number of training examples:", dataset.num_train_examples
+    print "Number of test examples:", dataset.num_test_examples
+
+    grid = sweep.parameter_grid(lrates, batch_sizes, max_epochs)
+    results = sweep.sweep(dataset, grid, working_directory, processes, blas_threads, patience)
+
+    best = results[0]
+    print "Best parameters: lrate {0} batch size {1} epochs {2} with misclassification {3:.1%}".format(
+        best['lrate'], best['batch_size'], best['epochs'], best['misclassification'])
+
+if __name__ == '__main__':
+    """List arguments for this program"""
+    parser = argparse.ArgumentParser(description='Search the training parameters of the MLP on the exercise dataset.')
+    parser.add_argument('-d', metavar='dataset', type=str, help="folder containing exercise dataset")
+    parser.add_argument('-o', metavar='output', default='./output/sweep', type=str, help="folder containing the trials and ranked results")
+    parser.add_argument('-c', metavar='cache', type=str, help="folder to cache parsed dataset files in")
+    parser.add_argument('-r', metavar='lrates', default='0.1,0.03,0.01,0.003', type=str, help="comma separated learning rates")
+    parser.add_argument('-b', metavar='batchsizes', default='30,100', type=str, help="comma separated batch sizes")
+    parser.add_argument('-e', metavar='epochs', default='10', type=str, help="comma separated maximal numbers of epochs")
+    parser.add_argument('-p', metavar='processes', type=int, help="number of trials trained in parallel, by default sized by cores and memory")
+    parser.add_argument('-t', metavar='threads', default=1, type=int, help="number of BLAS threads of every trial")
+    parser.add_argument('-s', metavar='patience', default=3, type=int, help="epochs without improvement before a trial stops")
+    args = parser.parse_args()
+
+    sys.exit(main(args.d, args.o, args.c, parse_list(args.r, float), parse_list(args.b, int),
+                  parse_list(args.e, int), args.p, args.t, args.s))
@@ -4,10 +4,11 @@ import os
 import numpy as np
 import csv
 
-from sklearn.metrics import confusion_matrix
 from training.acceleration_dataset import CSVAccelerationDataset
 from training.mlp_model import MLPMeasurementModelTrainer
+from training.evaluation import evaluate
 from converters import neon2iosmlp
+from serving.forward_propagator import ForwardPropagator, accuracy_delta
 from pylab import *
 
 
@@ -17,6 +18,7 @@ def visualise_dataset(dataset, output_image):
     # Choose some random examples to plot from the training data
     number_of_examples_to_plot = 3
     plot_ids = np.random.random_integers(0, dataset.num_train_examples - 1, number_of_examples_to_plot)
+    plot_features = dataset.flatten2d(dataset.train_examples.take(plot_ids))
 
     print "Ids of plotted examples:", plot_ids
 
@@ -36,12 +38,12 @@ def visualise_dataset(dataset, output_image):
     ax3 = subplot(313, sharex=ax1)
     ax3.set_ylabel('Z - Acceleration')
 
-    for i in plot_ids:
+    for features in plot_features:
         c = np.random.random((3,))
 
-        ax1.plot(range(0, dataset.num_features / 3), dataset.X_train[i, 0:400], '-o', c=c)
-        ax2.plot(range(0, dataset.num_features / 3), dataset.X_train[i, 400:800], '-o', c=c)
-        ax3.plot(range(0, dataset.num_features / 3), dataset.X_train[i, 800:1200], '-o', c=c)
+        ax1.plot(range(0, dataset.num_features / 3), features[0:400], '-o', c=c)
+        ax2.plot(range(0, dataset.num_features / 3), features[400:800], '-o', c=c)
+        ax3.plot(range(0, dataset.num_features / 3), features[800:1200], '-o', c=c)
 
     legend(map(label_of_example, plot_ids))
     suptitle('Feature values for the first three training examples', fontsize=16)
@@ -49,60 +51,38 @@ def visualise_dataset(dataset, output_image):
     savefig(output_image)
 
 
-def learn_model_from_data(dataset, working_directory, model_name):
+def learn_model_from_data(dataset, working_directory, model_name, quantization='float32'):
     """Use MLP to train the dataset and generate result in working_directory"""
     model_trainer = MLPMeasurementModelTrainer(working_directory)
 
     trained_model = model_trainer.train(dataset)
 
-    dataset.save_labels(os.path.join(working_directory, model_name + '_model.labels.txt'))
-    neon2iosmlp.convert(model_trainer.model_path, os.path.join(working_directory, model_name + '_model.weights.raw'))
-
+    # Writes the model container as well as the labels, layers and weights files the iOS app reads
     layers = model_trainer.layers(dataset, trained_model)
-    neon2iosmlp.write_layers_to_file(layers, os.path.join(working_directory, model_name + '_model.layers.txt'))
+    output_prefix = os.path.join(working_directory, model_name + '_model')
+    neon2iosmlp.export(model_trainer.model_path, layers, dataset.ordered_labels(), output_prefix, dtype=quantization)
+
+    if quantization != 'float32' and dataset.num_test_examples > 0:
+        report_quantization(model_trainer.model_path, layers, output_prefix, dataset)
 
     return model_trainer, trained_model
 
 
-def predict(model, dataset):
-    """Calculate the prediction of dataset with trained model"""
-    dataset.reset()
-    predictions = None
-    nprocessed = 0
-    for x, t in dataset:
-        pred = model.fprop(x, inference=True).asnumpyarray()
-        bsz = min(dataset.ndata - nprocessed, model.be.bsz)
-        nprocessed += bsz
-        if predictions is None:
-            predictions = pred[:, :bsz]
-        else:
-            predictions = np.hstack((predictions, pred[:, :bsz]))
-    return predictions
+def report_quantization(neon_model_path, layers, output_prefix, dataset):
+    """Compare the predictions of the quantized container with those of the float model on the test examples"""
+    reference = ForwardPropagator(layers, neon2iosmlp.extract_layers(neon_model_path))
+    quantized = ForwardPropagator.from_container(output_prefix + '.mlp')
+    report = accuracy_delta(reference, quantized, dataset.test_examples)
+
+    print "Quantization accuracy delta:", report['accuracy_delta']
+    write_to_csv(output_prefix + '.quantization.csv', sorted(report.items()))
 
 
 def show_evaluation(model, dataset):
     """Generate the evaluation table"""
-    # confusion_matrix(y_true, y_pred)
-    predicted = predict(model, dataset.test())
-    y_true = dataset.y_test
-    y_pred = np.argmax(predicted, axis=0)
-
-    confusion_mat = confusion_matrix(y_true, y_pred, range(0, dataset.num_labels))
-
-    # Fiddle around with cm to get it into table shape
-    confusion_mat = np.vstack((np.zeros((1, dataset.num_labels), dtype=int), confusion_mat))
-    confusion_mat = np.hstack((np.zeros((dataset.num_labels + 1, 1), dtype=int), confusion_mat))
-
-    table = confusion_mat.tolist()
-
+    evaluation, = evaluate([model], dataset.test(), dataset.y_test, dataset.num_labels, top_k=(1, 2))
     human_labels = map(dataset.human_label_for, range(0, dataset.num_labels))
-
-    for i, s in enumerate(human_labels):
-        table[0][i+1] = s
-        table[i+1][0] = s
-    table[0][0] = "actual \ predicted"
-
-    return table
+    return evaluation.table(human_labels)
 
 
 def write_to_csv(filename, data):
@@ -113,11 +93,13 @@ def write_to_csv(filename, data):
     csvfile.close()
 
 
-def main(dataset_directory, working_directory, evaluation_file, visualise_image, model_name, test_directory):
+def main(dataset_directory, working_directory, evaluation_file, visualise_image, model_name, test_directory,
+         cache_directory, processes, lazy_augmentation, dtype, quantization):
     """Main entry point."""
 
     # 1/ Load the dataset
-    dataset = CSVAccelerationDataset(dataset_directory, test_directory)
+    dataset = CSVAccelerationDataset(dataset_directory, test_directory, cache_directory=cache_directory,
+                                     processes=processes, lazy_augmentation=lazy_augmentation, dtype=np.dtype(dtype))
     print "Number of training examples:", dataset.num_train_examples
     print "Number of test examples:", dataset.num_test_examples
     print "Number of features:", dataset.num_features
@@ -127,7 +109,7 @@ def main(dataset_directory, working_directory, evaluation_file, visualise_image,
     visualise_dataset(dataset, visualise_image)
 
     # 3/ Train the dataset using MLP
-    mlpmodel, trained_model = learn_model_from_data(dataset, working_directory, model_name)
+    mlpmodel, trained_model = learn_model_from_data(dataset, working_directory, model_name, quantization)
 
     # 4/ Evaluate the trained model
     table = show_evaluation(trained_model, dataset)
@@ -144,10 +126,15 @@ if __name__ == '__main__':
     parser.add_argument('-e', metavar='evaluation', default='./output/evaluation.csv', type=str, help="evaluation csv file output")
     parser.add_argument('-v', metavar='visualise', default='./output/visualisation.png', type=str, help="visualisation dataset image output")
     parser.add_argument('-m', metavar='modelname', default='demo', type=str, help="prefix name of model")
+    parser.add_argument('-c', metavar='cache', type=str, help="folder to cache parsed dataset files in")
+    parser.add_argument('-p', metavar='processes', default=1, type=int, help="number of processes parsing the dataset")
+    parser.add_argument('-l', action='store_true', help="augment lazily and stream minibatches instead of materializing the dataset")
+    parser.add_argument('-f', metavar='dtype', default='float32', choices=['float32', 'float16'], help="storage type of the dataset")
+    parser.add_argument('-q', metavar='quantization', default='float32', choices=['float32', 'float16', 'int8'], help="storage type of the weights in the model container")
     args = parser.parse_args()
 
     #
     # A good example of command-line params is
     # -m core -d ../../muvr-training-data/labelled/core -o ../output/ -v ../output/v.png -e  ../output/e.csv
     #
-    sys.exit(main(args.d, args.o, args.e, args.v, args.m, args.t))
+    sys.exit(main(args.d, args.o, args.e, args.v, args.m, args.t, args.c, args.p, args.l, args.f, args.q))
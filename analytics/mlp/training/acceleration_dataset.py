@@ -1,13 +1,14 @@
 import collections
+import functools
 import numpy as np
 from neon.data import DataIterator
 import logging
 import os
-import csv
-import zipfile
-import tempfile
+from training import csv_loader
 from training.augmentation import SignalAugmenter
-from training.examples import ExampleColl
+from training.example_cache import ExampleCache
+from training.examples import ExampleColl, RaggedExamples
+from training.streaming_iterator import StreamingDataIterator
 
 
 class AccelerationDataset(object):
@@ -15,6 +16,8 @@ class AccelerationDataset(object):
     logger = logging.getLogger("training.AccelerationDataset")
 
     TRAIN_RATIO = 0.8
+    # Split every label with the train ratio, so that labels with few examples do not vanish from the test set
+    STRATIFIED_SPLIT = True
 
     # This defines the range of the values the accelerometer measures
     Feature_Range = 8000
@@ -22,6 +25,11 @@ class AccelerationDataset(object):
     
     Target_Feature_Length = 400
 
+    # Storage type of signals, augmented windows and features. Values are only converted to the type of the neon
+    # backend when they get handed to the model. The accelerometer values have about 3 significant digits, so even
+    # float16 is sufficient to store them
+    Default_Dtype = np.float32
+
     def human_label_for(self, label_id):
         """Convert a label id into a human readable string label."""
         return self.id_label_mapping[label_id]
@@ -48,7 +56,10 @@ class AccelerationDataset(object):
     
         dataset = self.generate_examples(dataset) if add_generated_examples else dataset
     
-        augmented = self.augmenter.augment_examples(dataset, self.Target_Feature_Length)
+        if self.lazy_augmentation:
+            augmented = self.augmenter.augment_examples_lazily(dataset, self.Target_Feature_Length)
+        else:
+            augmented = self.augmenter.augment_examples(dataset, self.Target_Feature_Length)
         self.logger.info("Augmented with %d examples, %d originally" % (
             augmented.num_examples - dataset.num_examples, dataset.num_examples))
         
@@ -59,25 +70,69 @@ class AccelerationDataset(object):
         return augmented
     
     # Load label mapping and train / test data from disk.
-    def __init__(self, train_examples, test_examples=None, add_generated_examples=True):
-        """Initialize the dataset using the provided train and test examples."""
+    def __init__(self, train_examples, test_examples=None, add_generated_examples=True, lazy_augmentation=False,
+                 dtype=Default_Dtype):
+        """Initialize the dataset using the provided train and test examples.
+
+        With lazy_augmentation the augmented windows are not copied. They only get materialized when `X_train` or
+        `X_test` are accessed, training and testing iterate over minibatches generated on the fly. The subclasses
+        parse the signals into the passed dtype, augmented windows and features keep the type of the examples they
+        are generated from. Examples passed in directly are not converted."""
 
         self.logger.info("Loading DS from files...")
         self.augmenter = SignalAugmenter(augmentation_start=0.1, augmentation_end=0.9)
+        self.lazy_augmentation = lazy_augmentation
+        self.dtype = dtype
 
-        train = self.prepare_dataset(train_examples, add_generated_examples)
-        test = self.prepare_dataset(test_examples, add_generated_examples)
+        self.train_examples = self.prepare_dataset(train_examples, add_generated_examples)
+        self.test_examples = self.prepare_dataset(test_examples, add_generated_examples)
+        self._X_train = None
+        self._X_test = None
 
         self.id_label_mapping = {v: k for k, v in self.label_id_mapping.items()}
-        self.X_train = self.flatten2d(train.features)
-        self.y_train = train.labels
-        self.X_test = self.flatten2d(test.features)
-        self.y_test = test.labels
+        self.y_train = self.train_examples.labels
+        self.y_test = self.test_examples.labels
 
         self.num_labels = len(self.id_label_mapping)
-        self.num_features = self.X_train.shape[1]
-        self.num_train_examples = self.X_train.shape[0]
-        self.num_test_examples = self.X_test.shape[0]
+        if self.lazy_augmentation:
+            self.num_features = self.train_examples.num_features
+        else:
+            self.num_features = self.X_train.shape[1]
+        self.num_train_examples = self.train_examples.num_examples
+        self.num_test_examples = self.test_examples.num_examples
+
+    @property
+    def X_train(self):
+        """Training features, one row per example."""
+        if self._X_train is None:
+            self._X_train = self.flatten2d(self.train_examples.features)
+        return self._X_train
+
+    @property
+    def X_test(self):
+        """Test features, one row per example."""
+        if self._X_test is None:
+            self._X_test = self.flatten2d(self.test_examples.features)
+        return self._X_test
+
+    def examples_from_signals(self, signals, label_mapper):
+        """Collect the labelled segments of the signals into an example collection.
+
+        Signals are `(xyz, offsets, labels)` tuples as returned by `csv_loader.load_csv`. All signals get copied into
+        one buffer, see `RaggedExamples.from_signals`."""
+        return self.examples_from_store(*RaggedExamples.from_signals(signals, self.dtype), label_mapper=label_mapper)
+
+    def examples_from_store(self, store, label_names, label_mapper):
+        """Example collection of the stored examples, whose labels are indexes into label_names. Label ids are
+        assigned in the order the labels first occur, the store itself is used as it is."""
+        label_ids = []
+        for label in label_names:
+            label = label_mapper(label)
+            if label not in self.label_id_mapping:
+                self.label_id_mapping[label] = len(self.label_id_mapping)
+            label_ids.append(self.label_id_mapping[label])
+        examples = RaggedExamples(store.data, store.offsets, np.asarray(label_ids, dtype=np.int64)[store.labels])
+        return ExampleColl(examples, examples.labels)
 
     @staticmethod
     def flatten2d(npa):
@@ -89,7 +144,16 @@ class AccelerationDataset(object):
 
     # Get the dataset ready for Neon training
     def train(self):
-        """Provide neon data iterator for training purposes."""
+        """Provide neon data iterator for training purposes.
+
+        A lazily augmented dataset is streamed in shuffled minibatches instead of materializing all windows."""
+        if self.lazy_augmentation:
+            return StreamingDataIterator(
+                self.train_examples,
+                nclass=self.num_labels,
+                lshape=(self.num_features, 1, 1),
+                shuffle=True)
+
         return DataIterator(
             X=self.X_train,
             y=self.y_train,
@@ -98,8 +162,13 @@ class AccelerationDataset(object):
             lshape=(self.num_features, 1, 1))
 
     def test(self):
-        """Provide neon data iterator for testing purposes."""
-        if self.num_test_examples > 0:
+        """Provide neon data iterator for testing purposes. The examples are provided in the order of `y_test`."""
+        if self.num_test_examples > 0 and self.lazy_augmentation:
+            return StreamingDataIterator(
+                self.test_examples,
+                nclass=self.num_labels,
+                lshape=(self.num_features, 1, 1))
+        elif self.num_test_examples > 0:
             return DataIterator(
                 X=self.X_test,
                 y=self.y_test,
@@ -111,55 +180,82 @@ class AccelerationDataset(object):
 
 
 class SparkAccelerationDataset(AccelerationDataset):
-    def __init__(self, example_list, label_mapper=lambda x: x, add_generated_examples = True):
+    def __init__(self, example_list, label_mapper=lambda x: x, add_generated_examples = True,
+                 dtype=AccelerationDataset.Default_Dtype):
         """Load the data from the provided nested list of examples."""
         self.label_id_mapping = {}
+        self.dtype = dtype
         examples = self.transform_to_example_coll(example_list, label_mapper)
         examples.shuffle()
 
-        train, test = examples.split(self.TRAIN_RATIO)
+        train, test = examples.split(self.TRAIN_RATIO, self.STRATIFIED_SPLIT)
 
-        super(SparkAccelerationDataset, self).__init__(train, test, add_generated_examples)
+        super(SparkAccelerationDataset, self).__init__(train, test, add_generated_examples, dtype=dtype)
 
     def transform_to_example_coll(self, examples, label_mapper):
-        def transform(example):
-            """Load a single example from a CSV file."""
-            single_examples = []
-            x_buffer = []
-            last_label = None
-            for row in example:
-                label = row["exercise"]
-                if last_label and label != last_label:
-                    x = np.transpose(np.reshape(np.asarray(x_buffer, dtype=float), (len(x_buffer), len(x_buffer[0]))))
-                    single_examples.append((label_mapper(last_label), x))
-                    x_buffer = []
-                x_buffer.append([row["x"], row["y"], row["z"]])
-                last_label = label
-            
-            if len(x_buffer) > 0:
-                x = np.transpose(np.reshape(np.asarray(x_buffer, dtype=float), (len(x_buffer), len(x_buffer[0]))))
-                single_examples.append((label_mapper(last_label), x))
-
-            return single_examples
-        
-        xs = []
-        ys = []
-        for example in examples:
-            for label, x in transform(example):
-                if label not in self.label_id_mapping:
-                    self.label_id_mapping[label] = len(self.label_id_mapping)
-                xs.append(x)
-                ys.append(self.label_id_mapping[label])
-
-        return ExampleColl(xs, ys)
+        """Examples are either a list of sessions or a spark RDD of sessions. A session is a list of rows with the
+        columns `exercise`, `x`, `y` and `z`.
+
+        The sessions of an RDD are converted on the executors, one partition at a time. Only the compact signal arrays
+        of every partition get sent to the driver."""
+        to_signals = functools.partial(sessions_to_signal, dtype=self.dtype)
+        if hasattr(examples, 'mapPartitions'):
+            signals = examples.mapPartitions(to_signals).collect()
+        else:
+            signals = list(to_signals(examples))
+        return self.examples_from_signals(signals, label_mapper)
+
+
+def session_columns(session):
+    """Columns of the rows of a session as `(xyz, labels)`. `xyz` is a `(3, N)` list of the values."""
+    xyz = [[row["x"] for row in session], [row["y"] for row in session], [row["z"] for row in session]]
+    return xyz, [row["exercise"] for row in session]
+
+
+def sessions_to_signal(sessions, dtype=AccelerationDataset.Default_Dtype):
+    """Convert sessions into a single signal, in the `(xyz, offsets, labels)` format of `csv_loader.load_csv`.
+
+    The sessions are concatenated. A session gets split into segments whenever the label changes. Rows with an empty
+    label get attached to the segment following them, a segment is labelled with the label of its last row. Yields
+    nothing if there are no sessions, e.g. for an empty partition."""
+    xs, ys, zs, labels, ends = [], [], [], [], []
+    num_samples = 0
+    for session in sessions:
+        if len(session) == 0:
+            continue
+        (x, y, z), session_labels = session_columns(session)
+        index = {}
+        codes = np.array([index.setdefault(label, len(index)) for label in session_labels])
+        empty = np.array([not label for label in session_labels])
+        changed = (codes[1:] != codes[:-1]) & ~empty[:-1]
+        session_ends = np.append(np.flatnonzero(changed) + 1, len(codes))
+
+        labels.extend(session_labels[end - 1] for end in session_ends)
+        ends.extend((session_ends + num_samples).tolist())
+        xs.append(x)
+        ys.append(y)
+        zs.append(z)
+        num_samples += len(session)
+
+    if ends:
+        xyz = np.array([np.concatenate(xs), np.concatenate(ys), np.concatenate(zs)], dtype=dtype)
+        yield xyz, np.append(0, ends).astype(np.int64), labels
 
 class CSVAccelerationDataset(AccelerationDataset):
-    def __init__(self, directory, test_directory=None, label_mapper=lambda x: x, add_generated_examples = True):
+    def __init__(self, directory, test_directory=None, label_mapper=lambda x: x, add_generated_examples = True,
+                 cache_directory=None, processes=1, lazy_augmentation=False,
+                 dtype=AccelerationDataset.Default_Dtype):
         """Load the dataset data from the directory.
 
         If two directories are passed the second is interpreted as the test dataset. If only one dataset gets passed,
          this dataset will get split into test and train. The label_mapper`allows to modify loaded labels. This is
-         useful e.g. to map multiple labels to a single on ("arms/biceps-curl" --> "-/exercising", ...)."""
+         useful e.g. to map multiple labels to a single on ("arms/biceps-curl" --> "-/exercising", ...). If a
+         cache_directory is passed, parsed CSV files are kept there and only new or changed files get parsed. The CSV
+         files get parsed by a pool of `processes` processes. See `AccelerationDataset` for lazy_augmentation and
+         dtype."""
+        self.cache = ExampleCache(cache_directory, dtype) if cache_directory else None
+        self.processes = processes
+        self.dtype = dtype
         
         # If we get provided with a test directory, we are going to use that. Otherwise we will split the dataset in
         # test and train on our own.
@@ -170,9 +266,9 @@ class CSVAccelerationDataset(AccelerationDataset):
             examples = self.load_examples(directory, label_mapper)
             examples.shuffle()
 
-            train, test = examples.split(self.TRAIN_RATIO)
+            train, test = examples.split(self.TRAIN_RATIO, self.STRATIFIED_SPLIT)
         
-        super(CSVAccelerationDataset, self).__init__(train, test, add_generated_examples)
+        super(CSVAccelerationDataset, self).__init__(train, test, add_generated_examples, lazy_augmentation, dtype)
     
     def load_examples(self, path, label_mapper):
         """
@@ -182,70 +278,37 @@ class CSVAccelerationDataset(AccelerationDataset):
 
         Arguments:
 
-        :param path: can be directory or zipfile. If zipfile, it will be extracted to a temporary path with prefix ``/tmp/muvr-training-``
+        :param path: can be directory or zipfile. A zipfile is read in place, without extracting it
         :param label_mapper: the mapper
         :return:
         """
         self.label_id_mapping = {}
-        root_directory = ""
         if os.path.isdir(path):
-            root_directory = path
+            csv_files = []
+            def append_csv_file(arg, direname, names):
+                for name in names:
+                    f = os.path.join(direname, name)
+                    if os.path.isfile(f) and f.endswith("csv"):
+                        csv_files.append(f)
+
+            os.path.walk(path, append_csv_file, None)
+            # Fix the order of the files to get the same examples and label ids independent of the file system
+            csv_files.sort()
         else:
-            # Zip file - extract to temp root_directory first
-            root_directory = tempfile.mkdtemp(prefix="/tmp/muvr-training-")
-            zipfile.ZipFile(path, 'r').extractall(root_directory)
-
-        #csv_files = filter(lambda f: f.endswith("csv"), os.listdir(root_directory))
-        csv_files = []
-        def append_csv_file(arg, direname, names):
-            for name in names:
-                f = os.path.join(direname, name)
-                if os.path.isfile(f) and f.endswith("csv"):
-                    csv_files.append(f)
-
-        os.path.walk(root_directory, append_csv_file, None)
-        xs = []
-        ys = []
-        for f in csv_files:
-            for label, x in self.load_example(f, label_mapper):
-                if label not in self.label_id_mapping:
-                    self.label_id_mapping[label] = len(self.label_id_mapping)
-                xs.append(x)
-                ys.append(self.label_id_mapping[label])
-
-        return ExampleColl(xs, ys)
+            csv_files = csv_loader.zip_sources(path)
+
+        if self.cache:
+            # The cached store of all files is memory-mapped instead of being copied into memory
+            store, label_names = self.cache.load_store(csv_files, self.processes)
+            self.cache.save()
+            return self.examples_from_store(store, label_names, label_mapper)
+
+        parsed_files = csv_loader.load_csv_files(csv_files, self.processes, self.dtype)
+        return self.examples_from_signals(parsed_files, label_mapper)
 
     @staticmethod
     def load_example(filename, label_mapper):
         """Load a single example from a CSV file.
-        Return a dictionary object with key is label, value is the list of data with that label"""
-        single_examples = []
-        
-        with open(filename, 'rb') as csvfile:
-            dialect = csv.Sniffer().sniff(csvfile.read(1024))
-            csvfile.seek(0)
-            csv_data = csv.reader(csvfile, dialect)
-
-            x_buffer = []
-            last_label = None
-            for row in csv_data:
-                if len(row) == 7:
-                    # New format (len = 7)
-                    #   X | Y | Z | '' | '' | '' | ''(without label)
-                    #   X | Y | Z | biceps-curl | intensity | weight | repetition
-                    new_data = row[0:3]
-                    label = row[3]
-                    if last_label and label != last_label:
-                        x = np.transpose(np.reshape(np.asarray(x_buffer, dtype=float), (len(x_buffer), len(x_buffer[0]))))
-                        single_examples.append((label_mapper(last_label), x))
-                        x_buffer = []
-                    x_buffer.append(new_data)
-                    last_label = label
-                else:
-                    raise Exception("Bad format")
-
-            if len(x_buffer) > 0:
-                x = np.transpose(np.reshape(np.asarray(x_buffer, dtype=float), (len(x_buffer), len(x_buffer[0]))))
-                single_examples.append((label_mapper(last_label), x))
-
-        return single_examples
+        Return a list of `(label, data)` tuples, one for each consecutive run of rows carrying the same label"""
+        xyz, offsets, labels = csv_loader.load_csv(filename)
+        return csv_loader.split_segments(xyz, offsets, labels, label_mapper)
@@ -1,7 +1,7 @@
 """Create new examples from existing one reproducing natural variation in the data"""
 
 import numpy as np
-from training.examples import ExampleColl
+from training.examples import ExampleColl, RaggedExamples, WindowedExampleColl
 import logging
 
 
@@ -20,9 +20,10 @@ class SignalAugmenter(object):
         """Augments all the passed examples (should be a np array with 3 dimensions)."""
         augmented = []
         augmented_labels = []
+        labels = examples.labels
         for i, features in enumerate(examples.features):
             if np.shape(features)[1] >= target_feature_length:
-                one_augmented, one_labels = self.augment_example(features, examples.labels[i], target_feature_length)
+                one_augmented, one_labels = self.augment_example(features, labels[i], target_feature_length)
                 augmented.append(one_augmented)
                 augmented_labels.append(one_labels)
             else:
@@ -34,11 +35,57 @@ class SignalAugmenter(object):
         else:
             return ExampleColl(np.empty((0, target_feature_length)), np.empty((0, 1)))
         
+    def augment_examples_lazily(self, examples, target_feature_length, window_step_size=5):
+        """Augments all the passed examples without copying the windows.
+
+        Only the original signals are kept together with the start offsets of the windows. The windows get materialized
+        on request, e.g. one minibatch at a time."""
+        # Windows are taken straight out of the store of the examples. Examples stored in a list get copied into a
+        # store first
+        store = examples.stored_features
+        if isinstance(store, RaggedExamples):
+            positions = examples.storage_indices(np.arange(examples.num_examples))
+        else:
+            store = RaggedExamples.from_list(examples.features, examples.labels)
+            positions = np.arange(examples.num_examples)
+
+        starts = []
+        labels = []
+        lengths = store.lengths()
+        example_labels = examples.labels
+        for i, idx in enumerate(positions):
+            sample_length = lengths[idx]
+            if sample_length >= target_feature_length:
+                offsets = self.window_offsets(sample_length, target_feature_length, window_step_size)
+                starts.append(offsets + store.offsets[idx])
+                labels.append(np.repeat(example_labels[i], len(offsets)))
+            else:
+                self.logger.warn("Dropped an example because it was to short. Length: %d Expected: %d" %
+                                 (sample_length, target_feature_length))
+
+        if len(starts) > 0:
+            return WindowedExampleColl(store.data, np.hstack(starts), np.hstack(labels), target_feature_length)
+        else:
+            return WindowedExampleColl(store.data, np.empty(0, dtype=int), np.empty(0), target_feature_length)
+
     def augment_example(self, example, label, target_length, window_step_size=5):
         """Example should be a numpy array, label a single label id."""
         dimensions = np.shape(example)[0]
         sample_length = np.shape(example)[1]
 
+        offsets = self.window_offsets(sample_length, target_length, window_step_size)
+        num_augmented = len(offsets)
+        augmented = np.empty((num_augmented, dimensions, target_length), dtype=example.dtype)
+        labels = np.empty(num_augmented)
+        labels.fill(label)
+        # Use a sliding window to move it over the input example. this will create new examples that can be used for
+        # training a model
+        for idx, i in enumerate(offsets):
+            augmented[idx, :, :] = example[:, i:(i + target_length)]
+        return augmented, labels
+
+    def window_offsets(self, sample_length, target_length, window_step_size):
+        """Start offsets of the windows `augment_example` cuts out of an example of the given length."""
         # Those will define start and end of the data augmentation window, e.g. how far the window is moved over the
         # data. This assumes the first fraction of `augmentation_start` and the last fraction of `augmentation_end`
         # measurement points to be noise
@@ -47,18 +94,6 @@ class SignalAugmenter(object):
 
         # Make sure we got enough data to get a complete example
         if (max_idx - min_idx) < target_length:
-            start = (sample_length - target_length) / 2
-            end = start + target_length
-            return example[np.newaxis, :, start:end], np.array(label)
+            return np.array([(sample_length - target_length) / 2])
         else:
-            augmentation_range = range(min_idx, max_idx - target_length, window_step_size)
-            num_augmented = len(augmentation_range)
-            augmented = np.empty((num_augmented, dimensions, target_length))
-            labels = np.empty(num_augmented)
-            labels.fill(label)
-            # Use a sliding window to move it over the input example. this will create new examples that can be used for
-            # training a model
-            for i in augmentation_range:
-                idx = (i - min_idx) / window_step_size
-                augmented[idx, :, :] = example[:, i:(i + target_length)]
-            return augmented, labels
+            return np.arange(min_idx, max_idx - target_length, window_step_size)
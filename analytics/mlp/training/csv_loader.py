@@ -0,0 +1,125 @@
+"""Columnar loading of labelled acceleration data stored in CSV files."""
+
+import functools
+import multiprocessing
+import os
+import zipfile
+import numpy as np
+
+# Files are stored in the `single-exercise-extended` format:
+#   X | Y | Z | biceps-curl | intensity | weight | repetition
+# Rows without a label leave the last four columns empty.
+Num_Columns = 7
+Label_Column = 3
+
+
+def parse_csv(content, dtype=np.float32):
+    """Parse the content of a CSV file into its acceleration signal and its labelled segments.
+
+    Returns a tuple `(xyz, offsets, labels)`. `xyz` is a `(3, N)` array holding the X, Y and Z columns. Segment `i`
+    spans the samples `offsets[i]:offsets[i + 1]` and is labelled with `labels[i]`."""
+    rows = [line.split(',') for line in content.splitlines()]
+    if len(rows) == 0:
+        return np.empty((3, 0), dtype=dtype), np.zeros(1, dtype=np.int64), []
+
+    if any(len(row) != Num_Columns for row in rows):
+        raise Exception("Bad format")
+
+    # Parse all X values, then all Y and Z values in one go. This directly results in a (3, N) array. Values are parsed
+    # with at least the precision of the requested dtype, numpy can not parse text into types smaller than float32.
+    columns = zip(*rows)
+    parse_dtype = np.promote_types(dtype, np.float32)
+    xyz = np.fromstring(",".join(columns[0] + columns[1] + columns[2]), dtype=parse_dtype, sep=',')
+    if xyz.size != 3 * len(rows):
+        raise Exception("Bad format")
+    xyz = xyz.reshape((3, len(rows))).astype(dtype, copy=False)
+
+    names, codes = np.unique(columns[Label_Column], return_inverse=True)
+
+    # A new segment starts whenever the label changes. Rows without a label get attached to the segment following
+    # them, so a change away from the empty label does not start a new segment.
+    changed = codes[1:] != codes[:-1]
+    if names[0] == '':
+        changed &= codes[:-1] != 0
+    ends = np.append(np.flatnonzero(changed) + 1, len(codes))
+    offsets = np.append(0, ends).astype(np.int64)
+
+    # A segment is labelled with the label of its last row
+    labels = names[codes[ends - 1]].tolist()
+    return xyz, offsets, labels
+
+
+def zip_sources(path):
+    """List the CSV files contained in the zip archive as sources that can be passed to `load_csv`."""
+    with zipfile.ZipFile(path, 'r') as archive:
+        return sorted((path, name) for name in archive.namelist() if name.endswith("csv"))
+
+
+# The zip archive most recently read by this process as `(key, archive)`. Opening an archive parses its whole central
+# directory, so reading one member after the other from a freshly opened archive would take quadratic time
+_open_archive = None
+
+
+def open_archive(path):
+    """The zip archive at the path, kept open for further reads. Only the most recently read archive stays open.
+
+    The archive gets reopened if the file changed, and it is never shared with a forked process, where a shared file
+    offset would mix up concurrent reads."""
+    global _open_archive
+    st = os.stat(path)
+    key = (os.getpid(), path, st.st_size, st.st_mtime)
+    if _open_archive is not None and _open_archive[0] == key:
+        return _open_archive[1]
+    if _open_archive is not None and _open_archive[0][0] == key[0]:
+        _open_archive[1].close()
+    _open_archive = (key, zipfile.ZipFile(path, 'r'))
+    return _open_archive[1]
+
+
+def read_source(source):
+    """Read the content of a CSV file.
+
+    The source is either the path of the file or a `(path, name)` tuple referring to a file in a zip archive. Files in
+    archives are read in place, without extracting them to disk first. See `open_archive`."""
+    if isinstance(source, tuple):
+        path, name = source
+        return open_archive(path).read(name)
+    else:
+        with open(source, 'rb') as csvfile:
+            return csvfile.read()
+
+
+def load_csv(source, dtype=np.float32):
+    """Load the acceleration signal and its labelled segments from the CSV file. See `parse_csv` and `read_source`."""
+    return parse_csv(read_source(source), dtype)
+
+
+def map_sources(func, sources, processes=1):
+    """Apply the function to all sources, spreading the calls over a pool of processes if more than one process is
+    requested. The function needs to be picklable.
+
+    The results are in the same order as the passed sources, independent of the number of processes."""
+    if processes > 1 and len(sources) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            # Hand out files in chunks to keep the communication overhead low, while still giving every process a few
+            # chunks to balance out files of different size
+            chunksize = max(1, len(sources) / (4 * processes))
+            return pool.map(func, sources, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [func(s) for s in sources]
+
+
+def load_csv_files(sources, processes=1, dtype=np.float32):
+    """Load all the CSV files, spreading the parsing over a pool of processes. See `map_sources`."""
+    return map_sources(functools.partial(load_csv, dtype=dtype), sources, processes)
+
+
+def split_segments(xyz, offsets, labels, label_mapper):
+    """Turn the segments of a signal into a list of `(label, 3xN array)` examples.
+
+    The examples are views into `xyz`, no data gets copied."""
+    return [(label_mapper(label), xyz[:, offsets[i]:offsets[i + 1]]) for i, label in enumerate(labels)]
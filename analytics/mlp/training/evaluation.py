@@ -0,0 +1,93 @@
+"""Batched prediction and incremental evaluation of trained models."""
+
+import numpy as np
+
+
+class Evaluation(object):
+    """Evaluation of the predictions of a model, updated one minibatch at a time.
+
+    Keeps the confusion matrix, from which accuracy, precision and recall of every label are derived, and the number of
+    examples whose label is within the `k` most likely predicted labels for every requested `k`."""
+
+    def __init__(self, num_labels, top_k=(1,)):
+        self.num_labels = num_labels
+        self.top_k = sorted(set(min(k, num_labels) for k in top_k))
+        self.confusion = np.zeros((num_labels, num_labels), dtype=np.int64)
+        self.top_k_counts = np.zeros(len(self.top_k), dtype=np.int64)
+        self.num_examples = 0
+
+    def update(self, predictions, labels):
+        """Add a minibatch of `(num_labels, batch size)` predictions and the true labels of its examples."""
+        labels = np.asarray(labels, dtype=np.int64)
+        predicted = np.argmax(predictions, axis=0)
+        self.confusion += np.bincount(labels * self.num_labels + predicted,
+                                      minlength=self.num_labels * self.num_labels).reshape(self.confusion.shape)
+
+        # Rank of the true label: the number of labels that got a higher prediction. Ties are broken like argmax does,
+        # in favour of the lower label, so that top-1 hits are exactly the diagonal of the confusion matrix
+        true_predictions = predictions[labels, np.arange(len(labels))]
+        lower = np.arange(self.num_labels)[:, np.newaxis] < labels
+        ranks = np.sum((predictions > true_predictions) | ((predictions == true_predictions) & lower), axis=0)
+        self.top_k_counts += [np.sum(ranks < k) for k in self.top_k]
+        self.num_examples += len(labels)
+
+    def accuracy(self):
+        return np.trace(self.confusion) / float(max(self.num_examples, 1))
+
+    def top_k_accuracy(self, k):
+        return self.top_k_counts[self.top_k.index(min(k, self.num_labels))] / float(max(self.num_examples, 1))
+
+    def precision(self):
+        """Precision of every label. Labels that never got predicted have a precision of 0."""
+        predicted = self.confusion.sum(axis=0)
+        return np.diag(self.confusion) / np.maximum(predicted, 1).astype(float)
+
+    def recall(self):
+        """Recall of every label. Labels without examples have a recall of 0."""
+        actual = self.confusion.sum(axis=1)
+        return np.diag(self.confusion) / np.maximum(actual, 1).astype(float)
+
+    def table(self, human_labels):
+        """Confusion matrix as table with a header row and column of the labels, followed by the precision and recall
+        of every label."""
+        table = [["actual \\ predicted"] + list(human_labels)]
+        for label, row in zip(human_labels, self.confusion.tolist()):
+            table.append([label] + row)
+        table.append([])
+        table.append(["precision"] + self.precision().tolist())
+        table.append(["recall"] + self.recall().tolist())
+        for k in self.top_k:
+            table.append(["top-%d accuracy" % k, self.top_k_accuracy(k)])
+        return table
+
+
+def batches(models, dataset):
+    """Predictions of all models for every minibatch of the neon data iterator, in a single pass over the data.
+
+    Yields the offset of the minibatch, the number of examples it contains and a list with the `(nclass, examples)`
+    predictions of every model. Examples used to fill up the last minibatch are left out."""
+    dataset.reset()
+    nprocessed = 0
+    for x, t in dataset:
+        bsz = min(dataset.ndata - nprocessed, models[0].be.bsz)
+        yield nprocessed, bsz, [model.fprop(x, inference=True).asnumpyarray()[:, :bsz] for model in models]
+        nprocessed += bsz
+
+
+def predict(model, dataset):
+    """Calculate the `(nclass, ndata)` predictions of the model for all examples of the neon data iterator."""
+    predictions = np.empty((dataset.nclass, dataset.ndata), dtype=np.float32)
+    for start, bsz, (pred,) in batches([model], dataset):
+        predictions[:, start:start + bsz] = pred
+    return predictions
+
+
+def evaluate(models, dataset, labels, num_labels, top_k=(1,)):
+    """Evaluate several models, e.g. the checkpoints of a training run, in a single pass over the neon data iterator.
+
+    Labels are the true labels of the examples in the order of the iterator. Returns the `Evaluation` of every model."""
+    evaluations = [Evaluation(num_labels, top_k) for _ in models]
+    for start, bsz, predictions in batches(models, dataset):
+        for evaluation, pred in zip(evaluations, predictions):
+            evaluation.update(pred, labels[start:start + bsz])
+    return evaluations
@@ -0,0 +1,204 @@
+"""Persistent cache of parsed CSV files to avoid reparsing unchanged training data."""
+
+import os
+import errno
+import functools
+import hashlib
+import logging
+import cPickle as pkl
+import numpy as np
+from training import csv_loader
+from training.examples import RaggedExamples
+
+
+class ExampleCache(object):
+    """Cache of parsed labelled sessions stored in a directory.
+
+    Each parsed signal is stored as `<content hash>.<dtype>.npy` and gets memory-mapped when read back. An index maps
+    the path of a file together with its size and modification time to the content hash, so unchanged files do not
+    even need to be read. Files that got touched but did not change are recognised by their content hash. Whole sets
+    of files can also be kept combined into one memory-mapped store, see `load_store`."""
+    logger = logging.getLogger("training.ExampleCache")
+
+    Index_Filename = 'index.pkl'
+
+    def __init__(self, directory, dtype=np.float32):
+        """Open the cache stored in the directory. The directory gets created if it does not exist yet. Signals are
+        parsed into and stored using the dtype, signals of other dtypes in the same directory are kept separately."""
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if not (exc.errno == errno.EEXIST and os.path.isdir(directory)):
+                raise
+
+        # paths:    path -> (size, mtime, digest)
+        # segments: digest -> (offsets, labels)
+        # stores:   store key -> (digests, label names)
+        self.paths = {}
+        self.segments = {}
+        self.stores = {}
+        self.modified = False
+        index_path = os.path.join(directory, self.Index_Filename)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                self.paths, self.segments, self.stores = pkl.load(f)
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha1(content).hexdigest()
+
+    @staticmethod
+    def stat(source):
+        """Key, size and modification time identifying the current state of the file.
+
+        Files contained in a zip archive are identified by the state of the archive."""
+        if isinstance(source, tuple):
+            path, name = source
+            st = os.stat(path)
+            return (os.path.abspath(path), name), st.st_size, st.st_mtime
+        else:
+            st = os.stat(source)
+            return os.path.abspath(source), st.st_size, st.st_mtime
+
+    @staticmethod
+    def exists(key):
+        return os.path.exists(key[0] if isinstance(key, tuple) else key)
+
+    def data_path(self, digest):
+        return os.path.join(self.directory, '%s.%s.npy' % (digest, self.dtype.name))
+
+    def store_prefix(self, key):
+        return os.path.join(self.directory, key + '.store')
+
+    def has_store(self, key):
+        return key in self.stores and os.path.exists(self.store_prefix(key) + '.data.npy')
+
+    def store_key(self, digests):
+        return hashlib.sha1('%s\n%s' % (self.dtype.name, '\n'.join(digests))).hexdigest()
+
+    def known_digest(self, key, size, mtime):
+        """Content hash of an entry that did not change since it got cached. `None` if it is unknown."""
+        entry = self.paths.get(key)
+        if entry and entry[0] == size and entry[1] == mtime:
+            return entry[2]
+        return None
+
+    def remember(self, key, size, mtime, digest):
+        """Record the content hash of the entry in the index."""
+        if self.paths.get(key) != (size, mtime, digest):
+            self.paths[key] = (size, mtime, digest)
+            self.modified = True
+
+    def get(self, digest):
+        """Retrieve the parsed `(xyz, offsets, labels)` for the content hash. `None` if the content is not cached."""
+        if digest not in self.segments or not os.path.exists(self.data_path(digest)):
+            return None
+        offsets, labels = self.segments[digest]
+        return np.load(self.data_path(digest), mmap_mode='r'), offsets, labels
+
+    def put(self, digest, parsed):
+        """Store the parsed `(xyz, offsets, labels)` for the content hash."""
+        xyz, offsets, labels = parsed
+        # Write to a temporary file first to never leave a partially written entry behind
+        tmp_path = self.data_path(digest) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, xyz)
+        os.rename(tmp_path, self.data_path(digest))
+        self.segments[digest] = (offsets, labels)
+        self.modified = True
+
+    def cached_digests(self):
+        return frozenset(d for d in self.segments if os.path.exists(self.data_path(d)))
+
+    def load_files(self, sources, processes=1):
+        """Load the parsed files from the cache. Only files that are new or whose content changed get parsed.
+
+        Files that changed since they got cached are read once, by the worker process that hashes and, if the content
+        is not cached, parses them."""
+        return self.load_digests_and_files(sources, processes)[1]
+
+    def load_digests_and_files(self, sources, processes=1, stats=None):
+        """Content hashes and parsed content of the files, see `load_files`."""
+        stats = stats or [self.stat(s) for s in sources]
+        digests = [self.known_digest(key, size, mtime) for key, size, mtime in stats]
+        result = [self.get(digest) if digest else None for digest in digests]
+
+        unknown = [i for i, parsed in enumerate(result) if parsed is None]
+        if unknown:
+            self.logger.info("Reading %d of %d files, the others are cached" % (len(unknown), len(sources)))
+            read = functools.partial(digest_and_parse, cached_digests=self.cached_digests(), dtype=self.dtype)
+            for i, (digest, parsed) in zip(unknown, csv_loader.map_sources(read, [sources[i] for i in unknown],
+                                                                           processes)):
+                if parsed is None:
+                    # The file got touched but its content is cached
+                    parsed = self.get(digest)
+                else:
+                    self.put(digest, parsed)
+                digests[i] = digest
+                result[i] = parsed
+
+        for (key, size, mtime), digest in zip(stats, digests):
+            self.remember(key, size, mtime, digest)
+        return digests, result
+
+    def load_store(self, sources, processes=1):
+        """Load all files combined into one `RaggedExamples` store, see `RaggedExamples.from_signals`.
+        Returns the store and the label names its labels refer to.
+
+        The store is kept in the cache and gets memory-mapped. If none of the files changed it is loaded without
+        touching the files or their cached signals, otherwise the files are loaded as in `load_files`."""
+        stats = [self.stat(s) for s in sources]
+        digests = [self.known_digest(key, size, mtime) for key, size, mtime in stats]
+        if None in digests or not self.has_store(self.store_key(digests)):
+            digests, signals = self.load_digests_and_files(sources, processes, stats)
+            key = self.store_key(digests)
+            if not self.has_store(key):
+                store, names = RaggedExamples.from_signals(signals, self.dtype)
+                store.save(self.store_prefix(key))
+                self.stores[key] = (digests, names)
+                self.modified = True
+
+        key = self.store_key(digests)
+        return RaggedExamples.load(self.store_prefix(key)), self.stores[key][1]
+
+    def save(self):
+        """Persist the index. Entries of files that got deleted and data that is no longer referenced get removed."""
+        for key in [key for key in self.paths if not self.exists(key)]:
+            del self.paths[key]
+            self.modified = True
+
+        if not self.modified:
+            return
+
+        referenced = set(digest for _, _, digest in self.paths.values())
+        unreferenced = set(self.segments) - referenced
+        for digest in unreferenced:
+            del self.segments[digest]
+        # Remove the signals of all dtypes
+        for filename in os.listdir(self.directory):
+            if filename.split('.')[0] in unreferenced:
+                os.remove(os.path.join(self.directory, filename))
+        for key, (digests, _) in self.stores.items():
+            if not referenced.issuperset(digests):
+                del self.stores[key]
+                for name in RaggedExamples.__slots__:
+                    path = '%s.%s.npy' % (self.store_prefix(key), name)
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        index_path = os.path.join(self.directory, self.Index_Filename)
+        with open(index_path + '.tmp', 'wb') as f:
+            pkl.dump((self.paths, self.segments, self.stores), f, pkl.HIGHEST_PROTOCOL)
+        os.rename(index_path + '.tmp', index_path)
+        self.modified = False
+        self.logger.info("Stored index of %d cached files" % len(self.paths))
+
+
+def digest_and_parse(source, cached_digests=frozenset(), dtype=np.float32):
+    """Read the file once and return its content hash together with its parsed content, or `None` instead of the
+    parsed content if its hash is one of the cached digests."""
+    content = csv_loader.read_source(source)
+    digest = ExampleCache.digest(content)
+    return digest, None if digest in cached_digests else csv_loader.parse_csv(content, dtype)
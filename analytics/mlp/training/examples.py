@@ -1,46 +1,214 @@
 import random
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class RaggedExamples(object):
+    """Variable length examples stored back to back in one contiguous `(dimensions, total_samples)` buffer.
+
+    Example `i` is `data[:, offsets[i]:offsets[i + 1]]` and is labelled `labels[i]`. Indexing returns views into the
+    buffer. The whole store can be written with one call per array and read back memory-mapped."""
+    __slots__ = ('data', 'offsets', 'labels')
+
+    def __init__(self, data, offsets, labels):
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int64)
+
+    @classmethod
+    def from_list(cls, features, labels, dtype=None, dimensions=3):
+        """Copy a list of `(dimensions, N)` arrays into a new store."""
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum([np.shape(f)[1] for f in features], out=offsets[1:])
+        if dtype is None:
+            dtype = features[0].dtype if len(features) > 0 else np.float32
+        data = np.empty((dimensions, offsets[-1]), dtype=dtype)
+        for i, f in enumerate(features):
+            data[:, offsets[i]:offsets[i + 1]] = f
+        return cls(data, offsets, labels)
+
+    @classmethod
+    def from_signals(cls, signals, dtype=None):
+        """Copy the labelled segments of the signals back to back into a new store.
+
+        Signals are `(xyz, offsets, labels)` tuples as returned by `csv_loader.load_csv`. Returns the store together
+        with the distinct labels in the order they first occur. The labels of the store are indexes into those."""
+        if dtype is None:
+            dtype = signals[0][0].dtype if len(signals) > 0 else np.float32
+        total_length = sum(xyz.shape[1] for xyz, _, _ in signals)
+        data = np.empty((3, total_length), dtype=dtype)
+        # The segment offsets of every signal are shifted by the position of the signal in the buffer
+        offsets = [np.zeros(1, dtype=np.int64)]
+        names = {}
+        codes = []
+        signal_start = 0
+        for xyz, signal_offsets, labels in signals:
+            signal_end = signal_start + xyz.shape[1]
+            data[:, signal_start:signal_end] = xyz
+            offsets.append(np.asarray(signal_offsets[1:], dtype=np.int64) + signal_start)
+            codes.extend(names.setdefault(label, len(names)) for label in labels)
+            signal_start = signal_end
+        return cls(data, np.concatenate(offsets), codes), sorted(names, key=names.get)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[:, self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def save(self, prefix):
+        """Store the examples in the files `<prefix>.data.npy`, `<prefix>.offsets.npy` and `<prefix>.labels.npy`."""
+        for name in self.__slots__:
+            np.save("%s.%s.npy" % (prefix, name), getattr(self, name))
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """Load examples stored using `save`. By default the signal data is memory-mapped."""
+        return cls(np.load(prefix + ".data.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".offsets.npy"),
+                   np.load(prefix + ".labels.npy"))
 
 
 class ExampleColl(object):
-    """Collection of training examples. Provides useful helpers to modify the collection."""
+    """Collection of training examples. Provides useful helpers to modify the collection.
+
+    Shuffling and splitting never copy features. The collection keeps an index permutation over the stored features,
+    which can be shared between multiple collections. Features only get gathered when they are requested."""
 
     # To make debugging easier, lets avoid randomness
     Seed = 42  # time()
 
-    def __init__(self, features, labels):
-        self.features = features
-        self.labels = labels
-        self.num_examples = len(features)
+    def __init__(self, features, labels, indices=None):
+        """Indices select and order the examples of the stored features and labels. `None` selects all of them."""
+        self.stored_features = features
+        self.stored_labels = np.asarray(labels)
+        self.indices = indices
+        self.num_examples = len(features) if indices is None else len(indices)
         random.seed(self.Seed)
 
-    def split(self, ratio):
+    def storage_indices(self, positions):
+        """Map positions of examples in this collection to indices into the stored features."""
+        positions = np.asarray(positions, dtype=int)
+        if self.indices is None:
+            return positions
+        else:
+            return self.indices[positions]
+
+    @property
+    def features(self):
+        if self.indices is None:
+            return self.stored_features
+        elif isinstance(self.stored_features, np.ndarray):
+            return self.stored_features[self.indices]
+        else:
+            return [self.stored_features[i] for i in self.indices]
+
+    @property
+    def labels(self):
+        if self.indices is None:
+            return self.stored_labels
+        else:
+            return self.stored_labels[self.indices]
+
+    def subset(self, positions):
+        """Collection of the examples at the positions. The stored features are shared."""
+        return ExampleColl(self.stored_features, self.stored_labels, self.storage_indices(positions))
+
+    def split(self, ratio, stratified=False):
         """Split the collection into two parts.
 
-        The first part will be of the given ratio. Second part will contain the remaining examples."""
-        split_point = int(self.num_examples * ratio)
-        first = ExampleColl(self.features[0:split_point], self.labels[0:split_point])
-        second = ExampleColl(self.features[split_point:self.num_examples], self.labels[split_point:self.num_examples])
-        return first, second
+        The first part will be of the given ratio. Second part will contain the remaining examples. If stratified is
+        set, the ratio is applied to every label separately. Labels with at least two examples will be present in
+        both parts."""
+        if stratified:
+            first, second = self.stratified_split_positions(ratio)
+        else:
+            split_point = int(self.num_examples * ratio)
+            first, second = np.arange(split_point), np.arange(split_point, self.num_examples)
+        return self.subset(first), self.subset(second)
+
+    def stratified_split_positions(self, ratio):
+        """Positions of the examples of both parts of a stratified split, keeping the order of the examples."""
+        labels = self.labels
+        in_first = np.zeros(self.num_examples, dtype=bool)
+        for label in np.unique(labels):
+            positions = np.flatnonzero(labels == label)
+            count = len(positions)
+            num_first = int(round(count * ratio))
+            if count > 1:
+                num_first = min(max(num_first, 1), count - 1)
+            in_first[positions[:num_first]] = True
+        return np.flatnonzero(in_first), np.flatnonzero(~in_first)
+
+    def take(self, positions):
+        """Retrieve the features of the examples at the given positions as one array."""
+        idx = self.storage_indices(positions)
+        if isinstance(self.stored_features, np.ndarray):
+            return self.stored_features[idx]
+        else:
+            return np.array([self.stored_features[i] for i in idx])
 
     def scale_features(self, feature_range, feature_mean):
         """Scale the features of the examples using the passed range and mean."""
-        self.features = np.divide(np.subtract(self.features, feature_mean), feature_range / 2.0)
+        self.stored_features = np.divide(np.subtract(self.features, feature_mean), feature_range / 2.0)
+        self.stored_labels = self.labels
+        self.indices = None
 
     def shuffle(self):
-        """Shuffle the examples in this collection randomly."""
+        """Shuffle the examples in this collection randomly. Only the index permutation changes."""
         shuffled_idx = range(self.num_examples)
         random.shuffle(shuffled_idx)
 
-        shuffled = []
-        shuffled_labels = []
-        for i in shuffled_idx:
-            shuffled.append(self.features[i])
-            shuffled_labels.append(self.labels[i])
+        self.indices = self.storage_indices(shuffled_idx)
 
-        if isinstance(self.features, list):
-            self.features = shuffled
-            self.labels = shuffled_labels
-        else:
-            self.features = np.reshape(np.array(shuffled), (len(shuffled_labels),) + shuffled[0].shape)
-            self.labels = np.reshape(np.array(shuffled_labels), (len(shuffled_labels)))
+
+class WindowedExampleColl(ExampleColl):
+    """Collection of fixed length windows into a set of signals.
+
+    Only the signals and the start offsets of the windows are stored. The windows themselves are strided views into the
+    signals and get copied only when they are requested, e.g. one minibatch at a time."""
+
+    def __init__(self, signals, starts, labels, window_length, indices=None):
+        """Signals should be a 2D array of all signals concatenated along the time axis, starts the offsets of the
+        windows into it."""
+        # The start offsets take the place of the stored features
+        super(WindowedExampleColl, self).__init__(np.asarray(starts), labels, indices)
+        self.signals = signals
+        self.window_length = window_length
+
+    @property
+    def num_features(self):
+        return self.signals.shape[0] * self.window_length
+
+    def windows(self):
+        """View of all windows of the signals, indexed by their start offset. Nothing gets copied."""
+        dimensions, length = self.signals.shape
+        num_windows = max(length - self.window_length + 1, 0)
+        return as_strided(self.signals,
+                          shape=(num_windows, dimensions, self.window_length),
+                          strides=(self.signals.strides[1], self.signals.strides[0], self.signals.strides[1]))
+
+    def take(self, positions):
+        """Materialize the windows at the given positions into a `(len(positions), dimensions, window_length)` array."""
+        return self.windows()[self.stored_features[self.storage_indices(positions)]]
+
+    @property
+    def features(self):
+        """Materialize all windows. Prefer `take` to only copy the windows that are needed."""
+        return self.take(np.arange(self.num_examples))
+
+    def subset(self, positions):
+        """Collection of the windows at the positions. The signals are shared."""
+        return WindowedExampleColl(self.signals, self.stored_features, self.stored_labels, self.window_length,
+                                   self.storage_indices(positions))
+
+    def scale_features(self, feature_range, feature_mean):
+        """Scale the features of the examples using the passed range and mean."""
+        self.signals = np.divide(np.subtract(self.signals, feature_mean), feature_range / 2.0)
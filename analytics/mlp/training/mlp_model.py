@@ -25,8 +25,11 @@ class MLPMeasurementModelTrainer(object):
     Callback_Store_Filename = 'workout-mlp.h5'
     Intermediate_Model_Filename = 'workout-mlp-ep'
 
-    def __init__(self, root_path, lrate=0.01, batch_size=30, max_epochs=10):
-        """Initialize paths and loggers of the model."""
+    def __init__(self, root_path, lrate=0.01, batch_size=30, max_epochs=10, stop_func=None):
+        """Initialize paths and loggers of the model.
+
+        The stop function gets called with its state and the validation cost after every epoch, see neon's
+        `EarlyStopCallback`. It returns the new state and whether the training should stop."""
         # Storage director of the model and its snapshots
         self.root_path = root_path
         self.model_name = os.path.basename(self.root_path)
@@ -37,6 +40,7 @@ class MLPMeasurementModelTrainer(object):
         self.lrate = lrate
         self.batch_size = batch_size
         self.max_epochs = max_epochs
+        self.stop_func = stop_func
 
         # Set logging output...
         for name in ["neon.util.persist"]:
@@ -90,6 +94,9 @@ class MLPMeasurementModelTrainer(object):
         # add a callback that saves the best model state
         callbacks.add_save_best_state_callback(self.model_path)
 
+        if self.stop_func:
+            callbacks.add_early_stop_callback(self.stop_func)
+
         # Uncomment line below to run on GPU using cudanet backend
         # backend = gen_backend(rng_seed=0, gpu='cudanet')
         model.fit(
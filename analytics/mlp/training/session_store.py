@@ -0,0 +1,160 @@
+"""Storage of recorded sensor sessions, read in bulk batches."""
+
+import abc
+import contextlib
+import csv
+import itertools
+import operator
+import Queue
+import sqlite3
+import threading
+
+
+class SessionStore(object):
+    """Store of sensor sessions. A session is a list of rows, each row a dict with the `Columns`.
+
+    Sessions are read in batches and can be filtered by their exercises and muscle group. Their rows have the format
+    `SparkAccelerationDataset` expects, so the sessions can be passed to it directly:
+
+        SparkAccelerationDataset(store.sessions(muscle_groups=['arms']))
+
+    The sessions are only read while the dataset consumes them."""
+    __metaclass__ = abc.ABCMeta
+
+    Columns = ['x', 'y', 'z', 'exercise', 'intensity', 'weight', 'repetition']
+
+    @abc.abstractmethod
+    def session_ids(self, exercises=None, muscle_groups=None):
+        """Ids of the sessions containing any of the exercises and belonging to any of the muscle groups. `None`
+        does not filter."""
+
+    @abc.abstractmethod
+    def read_sessions(self, session_ids):
+        """Yield `(session id, rows)` of the sessions, in the order of the ids."""
+
+    def sessions(self, exercises=None, muscle_groups=None):
+        """Rows of all sessions matching the filters, see `session_ids`."""
+        for _, rows in self.read_sessions(self.session_ids(exercises, muscle_groups)):
+            yield rows
+
+    def session_rdd(self, sc, exercises=None, muscle_groups=None, num_partitions=None):
+        """Spark RDD of the sessions matching the filters. Only the ids get distributed, every partition reads its
+        sessions on the executor. The store needs to be picklable and reachable from the executors."""
+        ids = self.session_ids(exercises, muscle_groups)
+        return sc.parallelize(ids, num_partitions).mapPartitions(
+            lambda partition_ids: (rows for _, rows in self.read_sessions(list(partition_ids))))
+
+
+class ConnectionPool(object):
+    """Pool of at most `size` connections, which get created when they are first needed."""
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self.created = 0
+        self.lock = threading.Lock()
+        self.idle = Queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection. Waits for a connection to become idle if all connections are in use."""
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            conn = self.connect() if create else self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store backed by a SQLite database file. Works without any server, e.g. for tests and local training."""
+
+    # Number of sessions requested per query and number of rows fetched at once
+    Sessions_Per_Query = 64
+    Rows_Per_Fetch = 10000
+
+    Schema = [
+        "CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, muscle_group TEXT)",
+        "CREATE TABLE IF NOT EXISTS samples (session_id INTEGER NOT NULL, seq INTEGER NOT NULL, x REAL, y REAL, "
+        "z REAL, exercise TEXT, intensity REAL, weight REAL, repetition INTEGER, PRIMARY KEY (session_id, seq))",
+        "CREATE INDEX IF NOT EXISTS samples_exercise ON samples (exercise, session_id)",
+        "CREATE INDEX IF NOT EXISTS sessions_muscle_group ON sessions (muscle_group)"
+    ]
+
+    def __init__(self, filename, pool_size=4):
+        self.filename = filename
+        self.pool_size = pool_size
+        self.pool = ConnectionPool(self.connect, pool_size)
+        with self.pool.connection() as conn:
+            for statement in self.Schema:
+                conn.execute(statement)
+            conn.commit()
+
+    def connect(self):
+        return sqlite3.connect(self.filename, check_same_thread=False)
+
+    def __getstate__(self):
+        # Connections can not be pickled, e.g. when the store gets shipped to spark executors
+        return {'filename': self.filename, 'pool_size': self.pool_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], state['pool_size'])
+
+    def add_session(self, rows, muscle_group=None):
+        """Store a session. Rows are sequences of the values of the `Columns`. Returns the id of the new session."""
+        with self.pool.connection() as conn:
+            session_id = conn.execute("INSERT INTO sessions (muscle_group) VALUES (?)", (muscle_group,)).lastrowid
+            conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             ((session_id, seq) + tuple(row) for seq, row in enumerate(rows)))
+            conn.commit()
+        return session_id
+
+    def import_csv(self, filename, muscle_group=None):
+        """Store the session recorded in a CSV file in the `single-exercise-extended` format. Values of empty columns
+        are stored as `NULL`, except for empty exercises."""
+        def row_values(row):
+            x, y, z, exercise, intensity, weight, repetition = row
+            return (float(x), float(y), float(z), exercise,
+                    float(intensity) if intensity else None,
+                    float(weight) if weight else None,
+                    int(repetition) if repetition else None)
+
+        with open(filename, 'rb') as f:
+            return self.add_session((row_values(row) for row in csv.reader(f)), muscle_group)
+
+    def session_ids(self, exercises=None, muscle_groups=None):
+        query = "SELECT id FROM sessions"
+        conditions = []
+        params = []
+        if exercises is not None:
+            conditions.append("id IN (SELECT DISTINCT session_id FROM samples WHERE exercise IN (%s))" %
+                              ",".join("?" * len(exercises)))
+            params += list(exercises)
+        if muscle_groups is not None:
+            conditions.append("muscle_group IN (%s)" % ",".join("?" * len(muscle_groups)))
+            params += list(muscle_groups)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.pool.connection() as conn:
+            return [row[0] for row in conn.execute(query + " ORDER BY id", params)]
+
+    def read_sessions(self, session_ids):
+        session_ids = list(session_ids)
+        columns = ", ".join(self.Columns)
+        for start in range(0, len(session_ids), self.Sessions_Per_Query):
+            ids = session_ids[start:start + self.Sessions_Per_Query]
+            query = "SELECT session_id, %s FROM samples WHERE session_id IN (%s) ORDER BY session_id, seq" % \
+                    (columns, ",".join("?" * len(ids)))
+            with self.pool.connection() as conn:
+                cursor = conn.execute(query, ids)
+                fetched = itertools.chain.from_iterable(iter(lambda: cursor.fetchmany(self.Rows_Per_Fetch), []))
+                sessions = dict((session_id, [dict(zip(self.Columns, row[1:])) for row in rows])
+                                for session_id, rows in itertools.groupby(fetched, operator.itemgetter(0)))
+            for session_id in ids:
+                yield session_id, sessions.get(session_id, [])
@@ -0,0 +1,93 @@
+"""Neon data iterator generating minibatches on the fly instead of holding the whole dataset in memory."""
+
+import sys
+import threading
+import Queue
+import numpy as np
+from neon import NervanaObject
+
+
+class StreamingDataIterator(NervanaObject):
+    """Iterates over the examples of a collection in minibatches, materializing one minibatch at a time.
+
+    The collection needs to provide `take(indices)`, e.g. a `WindowedExampleColl`. Minibatches are prepared by a
+    background thread while the model processes the previous ones. Like the neon `DataIterator`, the last minibatch
+    of an epoch gets filled up with examples from the start of the epoch."""
+
+    # Number of minibatches the background thread prepares in advance
+    Prefetch_Batches = 4
+
+    def __init__(self, examples, nclass, lshape, shuffle=False, seed=42, prefetch=Prefetch_Batches):
+        """If shuffle is set, the examples are visited in a different random order in every epoch."""
+        self.examples = examples
+        self.labels = np.asarray(examples.labels, dtype=np.int32)
+        self.ndata = examples.num_examples
+        self.nclass = nclass
+        self.shape = lshape
+        self.nfeatures = int(np.prod(lshape))
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.prefetch = prefetch
+
+        self.Xbuf = self.be.iobuf(self.nfeatures)
+        self.ylabels = self.be.iobuf(1, dtype=np.int32)
+        self.ybuf = self.be.iobuf(self.nclass)
+
+    @property
+    def nbatches(self):
+        return -(-self.ndata // self.be.bsz)
+
+    def reset(self):
+        """Nothing to reset, every iteration starts a new epoch."""
+        pass
+
+    def epoch_order(self):
+        if self.shuffle:
+            return self.rng.permutation(self.ndata)
+        else:
+            return np.arange(self.ndata)
+
+    def host_batches(self, order, batches, stop):
+        """Materialize the minibatches of an epoch on the host and put them into the batches queue. Ends with `None`,
+        or with the `sys.exc_info()` of the error that stopped it, which gets raised again by the consumer."""
+        try:
+            bsz = self.be.bsz
+            # Wrap around to fill up the last minibatch
+            order = np.resize(order, self.nbatches * bsz)
+            for start in range(0, len(order), bsz):
+                if stop.is_set():
+                    return
+                idx = order[start:start + bsz]
+                x = self.examples.take(idx).reshape((bsz, self.nfeatures))
+                batches.put((np.ascontiguousarray(x.T, dtype=np.float32), self.labels[np.newaxis, idx]))
+            batches.put(None)
+        except Exception:
+            batches.put(sys.exc_info())
+
+    def __iter__(self):
+        batches = Queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.host_batches, args=(self.epoch_order(), batches, stop))
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if len(batch) == 3:
+                    exc_type, exc_value, exc_traceback = batch
+                    raise exc_type, exc_value, exc_traceback
+                x, y = batch
+                self.Xbuf.set(x)
+                self.ylabels.set(y)
+                self.ybuf[:] = self.be.onehot(self.ylabels, axis=0)
+                yield self.Xbuf, self.ybuf
+        finally:
+            # Unblock the producer in case the consumer stopped early
+            stop.set()
+            while producer.is_alive():
+                try:
+                    batches.get_nowait()
+                except Queue.Empty:
+                    producer.join(0.01)
@@ -0,0 +1,205 @@
+"""Parallel search of the training parameters of `MLPMeasurementModelTrainer`."""
+
+import csv
+import itertools
+import multiprocessing
+import os
+import time
+import cPickle as pkl
+import numpy as np
+from neon.transforms import Misclassification
+from training import utils
+from training.acceleration_dataset import AccelerationDataset
+from training.examples import ExampleColl, WindowedExampleColl
+from training.mlp_model import MLPMeasurementModelTrainer
+
+
+def share_dataset(dataset, directory):
+    """Store the prepared examples of the dataset in the directory, to be memory-mapped by `SharedDataset`s.
+
+    Lazily augmented examples are stored as signals and window offsets, which keeps the files small. Signals shared by
+    the train and test examples are stored once."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    signal_files = {}
+    saved = []
+    for name, examples in [('train', dataset.train_examples), ('test', dataset.test_examples)]:
+        prefix = os.path.join(directory, name)
+        positions = np.arange(examples.num_examples)
+        if isinstance(examples, WindowedExampleColl):
+            filename = next((f for signals, f in saved if signals is examples.signals), None)
+            if filename is None:
+                filename = name + '.signals.npy'
+                np.save(os.path.join(directory, filename), examples.signals)
+                saved.append((examples.signals, filename))
+            signal_files[name] = filename
+            np.save(prefix + '.starts.npy', examples.stored_features[examples.storage_indices(positions)])
+        else:
+            np.save(prefix + '.features.npy', examples.take(positions))
+        np.save(prefix + '.labels.npy', examples.labels)
+
+    window_length = getattr(dataset.train_examples, 'window_length', None)
+    with open(os.path.join(directory, 'labels.pkl'), 'wb') as f:
+        pkl.dump((dataset.label_id_mapping, window_length, signal_files), f, pkl.HIGHEST_PROTOCOL)
+
+
+class SharedDataset(AccelerationDataset):
+    """Dataset stored by `share_dataset`. The features are memory-mapped read only, so any number of processes can
+    use the same dataset while the memory is only needed once. Minibatches are streamed from the mapped files."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'labels.pkl'), 'rb') as f:
+            self.label_id_mapping, window_length, signal_files = pkl.load(f)
+        self.id_label_mapping = {v: k for k, v in self.label_id_mapping.items()}
+
+        # Both sides share the memory-mapped signals if they were stored once
+        signals = dict((f, np.load(os.path.join(directory, f), mmap_mode='r')) for f in set(signal_files.values()))
+        self.train_examples, self.test_examples = [
+            self.load_examples(os.path.join(directory, name), signals.get(signal_files.get(name)), window_length)
+            for name in ['train', 'test']]
+        self.lazy_augmentation = True
+        self.dtype = self.train_examples.take(np.arange(0)).dtype
+        self._X_train = None
+        self._X_test = None
+
+        self.y_train = self.train_examples.labels
+        self.y_test = self.test_examples.labels
+        self.num_labels = len(self.id_label_mapping)
+        self.num_train_examples = self.train_examples.num_examples
+        self.num_test_examples = self.test_examples.num_examples
+        if window_length:
+            self.num_features = self.train_examples.num_features
+        else:
+            self.num_features = int(np.prod(self.train_examples.stored_features.shape[1:]))
+
+    @staticmethod
+    def load_examples(prefix, signals, window_length):
+        labels = np.load(prefix + '.labels.npy')
+        if window_length:
+            return WindowedExampleColl(signals, np.load(prefix + '.starts.npy'), labels, window_length)
+        else:
+            return ExampleColl(np.load(prefix + '.features.npy', mmap_mode='r'), labels)
+
+
+class EarlyStopping(object):
+    """Stop function for neon's `EarlyStopCallback`, stopping trials that are unpromising.
+
+    A trial stops if its validation cost did not improve for `patience` epochs, or if after `min_epochs` its cost is
+    more than `prune_factor` times the best cost any trial reached in the same epoch. The best costs per epoch are
+    shared between all trials through a dict, e.g. a `multiprocessing.Manager().dict()`."""
+
+    def __init__(self, patience=3, prune_factor=1.5, min_epochs=2, best_costs=None):
+        self.patience = patience
+        self.prune_factor = prune_factor
+        self.min_epochs = min_epochs
+        self.best_costs = best_costs if best_costs is not None else {}
+        self.best = None
+        self.epochs = 0
+        self.epochs_without_improvement = 0
+        self.stopped = False
+
+    def __call__(self, state, cost):
+        cost = float(cost)
+        epoch = self.epochs
+        self.epochs += 1
+        if self.best is None or cost < self.best:
+            self.best = cost
+            self.epochs_without_improvement = 0
+        else:
+            self.epochs_without_improvement += 1
+
+        best_of_all = self.best_costs.get(epoch)
+        if best_of_all is None or cost < best_of_all:
+            self.best_costs[epoch] = cost
+            best_of_all = cost
+
+        self.stopped = (self.epochs_without_improvement >= self.patience or
+                        (self.epochs >= self.min_epochs and cost > self.prune_factor * best_of_all))
+        return state, self.stopped
+
+
+def parameter_grid(lrates, batch_sizes, max_epochs):
+    """All combinations of the training parameters."""
+    return [{'lrate': lrate, 'batch_size': batch_size, 'max_epochs': epochs}
+            for lrate, batch_size, epochs in itertools.product(lrates, batch_sizes, max_epochs)]
+
+
+# Best validation cost per epoch over all trials of the sweep the worker process is part of
+_best_costs = None
+
+
+def init_worker(blas_threads, best_costs):
+    global _best_costs
+    utils.limit_blas_threads(blas_threads)
+    _best_costs = best_costs
+
+
+def run_trial(trial_id, parameters, dataset_directory, output_directory, patience, prune_factor):
+    """Train a model using the parameters on the shared dataset. Returns the results of the trial."""
+    start = time.time()
+    dataset = SharedDataset(dataset_directory)
+    stopping = EarlyStopping(patience, prune_factor, best_costs=_best_costs)
+    trainer = MLPMeasurementModelTrainer(os.path.join(output_directory, 'trial-%d' % trial_id), stop_func=stopping,
+                                         **parameters)
+    model = trainer.train(dataset)
+    error = model.eval(dataset.test(), metric=Misclassification())
+
+    result = dict(parameters)
+    result.update({
+        'trial': trial_id,
+        'misclassification': float(np.ravel(error)[0]),
+        'best_validation_cost': stopping.best,
+        'epochs': stopping.epochs,
+        'stopped_early': stopping.stopped,
+        'duration': time.time() - start
+    })
+    return result
+
+
+Result_Columns = ['rank', 'trial', 'lrate', 'batch_size', 'max_epochs', 'misclassification', 'best_validation_cost',
+                  'epochs', 'stopped_early', 'duration']
+
+
+def write_results(results, filename):
+    """Write the results ranked by their misclassification error into a CSV file."""
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(Result_Columns)
+        for rank, result in enumerate(rank_results(results)):
+            result = dict(result, rank=rank + 1)
+            writer.writerow([result[column] for column in Result_Columns])
+
+
+def rank_results(results):
+    return sorted(results, key=lambda r: (r['misclassification'], r['best_validation_cost']))
+
+
+def sweep(dataset, grid, output_directory, processes=None, blas_threads=1, patience=3, prune_factor=1.5,
+          memory_per_worker=1 << 29):
+    """Train a model for every parameter combination of the grid on a pool of processes.
+
+    The dataset is stored once and shared by all trials, see `SharedDataset`. Trials stop early if they are not
+    promising, see `EarlyStopping`. The ranked results are written to `results.csv` in the output directory and
+    returned."""
+    dataset_directory = os.path.join(output_directory, 'dataset')
+    share_dataset(dataset, dataset_directory)
+
+    processes = processes or utils.local_pool_size(len(grid), blas_threads, memory_per_worker)
+    print "Running {0} trials using {1} processes\n".format(len(grid), processes)
+
+    manager = multiprocessing.Manager()
+    # Every process runs a single trial, which gives every trial a fresh neon backend
+    pool = multiprocessing.Pool(processes, init_worker, (blas_threads, manager.dict()), maxtasksperchild=1)
+    try:
+        pending = [pool.apply_async(run_trial, (i, parameters, dataset_directory, output_directory, patience,
+                                                prune_factor))
+                   for i, parameters in enumerate(grid)]
+        results = [p.get() for p in pending]
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+
+    write_results(results, os.path.join(output_directory, 'results.csv'))
+    return rank_results(results)
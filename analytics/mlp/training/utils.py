@@ -1,5 +1,6 @@
 import os
 import errno
+import multiprocessing
 
 
 def get_bytes_from_file(filename):
@@ -20,3 +21,61 @@ def remove_if_exists(filename):
             pass
         else:
             raise
+
+
+# Environment variables read by the BLAS libraries when they get loaded
+Blas_Thread_Variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# Functions of OpenBLAS and MKL changing the number of threads of an already loaded library
+Blas_Thread_Setters = ['openblas_set_num_threads', 'MKL_Set_Num_Threads']
+
+
+def limit_blas_threads(num_threads):
+    """Limit the number of threads BLAS uses for matrix operations.
+
+    Sets the environment variables, which applies the limit to processes started later on, and changes the limit of the
+    library numpy already loaded, if it is OpenBLAS or MKL. Returns `True` if the limit of the loaded library changed."""
+    import ctypes
+    import glob
+    import numpy as np
+
+    for name in Blas_Thread_Variables:
+        os.environ[name] = str(num_threads)
+
+    # Wheels of numpy bundle their BLAS in `.libs`, otherwise it is found by its name. Loading an already loaded
+    # library returns the loaded instance.
+    candidates = glob.glob(os.path.join(os.path.dirname(np.__file__), '.libs', '*.so*'))
+    candidates += ['libopenblas.so.0', 'libopenblas.so', 'libmkl_rt.so']
+    changed = False
+    for candidate in candidates:
+        try:
+            lib = ctypes.CDLL(candidate)
+        except OSError:
+            continue
+        for setter in Blas_Thread_Setters:
+            if hasattr(lib, setter):
+                getattr(lib, setter)(ctypes.c_int(num_threads))
+                changed = True
+        if changed:
+            break
+    return changed
+
+
+def available_memory():
+    """Memory in bytes that is available for new processes without swapping."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def local_pool_size(num_tasks, blas_threads, memory_per_worker):
+    """Number of worker processes that fit the cores, given the BLAS threads of every worker, and the available
+    memory, given the memory every worker needs. There is no point in more workers than tasks."""
+    by_cores = multiprocessing.cpu_count() // blas_threads
+    by_memory = available_memory() // memory_per_worker
+    return int(max(1, min(num_tasks, by_cores, by_memory)))
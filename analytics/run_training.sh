@@ -26,9 +26,9 @@ printf "\n\nSTART TRAINING & EVALUATION\n\n"
 
 if [ -z "$3" ]
 then
-    python mlp/start_training.py -d $DATASET -o $OUTPUT -e $EVAL -v $VISUAL
+    python mlp/start_training.py -d $DATASET -o $OUTPUT -e $EVAL -v $VISUAL -c $OUTPUT/cache
 else
-    python mlp/start_training.py -d $DATASET -o $OUTPUT -e $EVAL -v $VISUAL -t $3
+    python mlp/start_training.py -d $DATASET -o $OUTPUT -e $EVAL -v $VISUAL -c $OUTPUT/cache -t $3
 fi
 EXIT_CODE=$?
 if [[ $EXIT_CODE != 0 ]]
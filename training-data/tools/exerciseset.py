@@ -1,9 +1,15 @@
 from __future__ import print_function
 import argparse
+import csv
+import functools
+import hashlib
+import inspect
 import itertools
+import multiprocessing
 import os
 import fnmatch
 import sys
+import tempfile
 import numpy as np
 import extrema
 
@@ -69,10 +75,31 @@ def find_csv_files(filepath):
         for filename in fnmatch.filter(filenames, '*.csv'):
             yield os.path.join(root, filename)
 
-def data_from_csv(filename):
-    return np.genfromtxt(
-            filename, delimiter=',', usecols=(0, 1, -3, -2, -1),
-            converters=csv_converters, dtype=int)
+def int_or_missing(x):
+    # Empty and non-integer values become -1, like the missing values of np.genfromtxt
+    try:
+        return int(x)
+    except ValueError:
+        return -1
+
+def convert_column(column, converter):
+    # Convert every distinct value once
+    values, inverse = np.unique(column, return_inverse=True)
+    return np.array([converter(v) for v in values], dtype=int)[inverse]
+
+def data_from_lines(lines, known_only=False):
+    """Muscle group, move and the last three columns of the CSV lines as integers. With known_only, returns None
+    without converting the remaining columns if the muscle group or move of the first row is unknown."""
+    rows = np.array([row for row in csv.reader(lines) if row])
+    columns = [convert_column(rows[:,i], converter) for i, converter in sorted(csv_converters.items())]
+    if known_only and 0 in [c[0] for c in columns]:
+        return None
+    numeric = [convert_column(rows[:,i], int_or_missing) for i in range(-3, 0)]
+    return np.column_stack(columns + numeric)
+
+def data_from_csv(filename, known_only=False):
+    with open(filename, 'rb') as f:
+        return data_from_lines(f, known_only)
 
 def arr_to_csv(a):
     return ','.join([str(x) for x in a])
@@ -117,16 +144,83 @@ def attributes_from_array(a, features=all_features):
     return np.array(list(attrs))
 
 def attributes_from_csvfile(filename, features=all_features):
-    data = data_from_csv(filename)
-    first = data[0]
-
-    if 0 in first[0:2]:  # Is the muscle group and move known?
+    data = data_from_csv(filename, known_only=True)
+    if data is None:  # Is the muscle group and move known?
         return None
 
     return attributes_from_array(data, features)
 
-def attributes_from_csvfiles(filenames, features=all_features):
-    arrays = (attributes_from_csvfile(csv, features) for csv in filenames)
+# Hashes of the source files implementing the label and the features, by name
+_code_hashes = {}
+
+def code_hash(name):
+    """Hash of the source file implementing the label or feature. Cached values of a feature become stale whenever
+    its source file changes."""
+    if name not in _code_hashes:
+        func = label if name == 'label' else feature_map[name]
+        with open(inspect.getsourcefile(func), 'rb') as f:
+            _code_hashes[name] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return _code_hashes[name]
+
+def cache_path(cache_dir, key, name):
+    return os.path.join(cache_dir, '%s.%s.%s.npy' % (key, name, code_hash(name)))
+
+def load_cached(cache_dir, key, name):
+    try:
+        return np.load(cache_path(cache_dir, key, name))
+    except IOError:
+        return None
+
+def save_cached(cache_dir, key, name, values):
+    # Write to a temporary file first, so that other processes never read a partially written file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, values)
+    os.rename(tmp, cache_path(cache_dir, key, name))
+
+def cached_attributes_from_csvfile(filename, features=all_features, cache_dir=None):
+    """Like attributes_from_csvfile, but every feature is cached in cache_dir, keyed by the hash of the file content.
+    Only features missing from the cache get computed, which parses the file."""
+    if cache_dir is None:
+        return attributes_from_csvfile(filename, features)
+
+    with open(filename, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha1(content).hexdigest()
+
+    # Files with unknown muscle group or move are cached with an empty label
+    names = ('label',) + tuple(features)
+    cached = dict((name, load_cached(cache_dir, key, name)) for name in names)
+    if cached['label'] is not None and cached['label'].size == 0:
+        return None
+
+    missing = [name for name in names if cached[name] is None]
+    if missing:
+        data = data_from_lines(content.splitlines(), known_only=True)
+        if data is None:  # Is the muscle group and move known?
+            save_cached(cache_dir, key, 'label', np.array([], dtype=int))
+            return None
+
+        xyz = xyz_arrays(data)
+        for name in missing:
+            values = [label(data)] if name == 'label' else list(feature_map[name](xyz))
+            cached[name] = np.array(values)
+            save_cached(cache_dir, key, name, cached[name])
+
+    return np.concatenate([cached[name] for name in names])
+
+def attributes_from_csvfiles(filenames, features=all_features, cache_dir=None, processes=None):
+    """Attributes of all files, computed in a pool of processes. processes defaults to the number of cores."""
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    attributes = functools.partial(cached_attributes_from_csvfile, features=features, cache_dir=cache_dir)
+    pool = multiprocessing.Pool(processes)
+    try:
+        arrays = pool.map(attributes, filenames, chunksize=4)
+    finally:
+        pool.close()
+        pool.join()
     arrays = [a for a in arrays if a is not None]  # Filter empty values out
     return np.array(arrays)
 
@@ -135,14 +229,20 @@ def create_arg_parser(description='Parse exercise set'):
     p.add_argument('directory', metavar='DIR', type=str, help='Directory to scan CSV from')
     p.add_argument('--features', nargs='+', choices=all_features, type=str,
             default=all_features, help='Features to include in the result')
+    p.add_argument('--cache', metavar='DIR', type=str, default=None,
+            help='Directory to cache the features of every file in, by default nothing is cached')
+    p.add_argument('--processes', type=int, default=None,
+            help='Number of processes computing features, by default the number of cores')
     return p
 
 if __name__ == '__main__':
-    opts = create_arg_parser().parse_args()
+    p = create_arg_parser()
+    p.add_argument('--output', metavar='FILE', type=str, default='exerciseset.npy',
+            help='File to write the attributes of all files to, one row per file starting with the label')
+    opts = p.parse_args()
     csvpaths = find_csv_files(opts.directory)
 
-    for csvfile in csvpaths:
-        attrs = attributes_from_csvfile(csvfile, opts.features)
-        if attrs is not None:
-            print(arr_to_csv(attrs))
+    attrs = attributes_from_csvfiles(csvpaths, opts.features, opts.cache, opts.processes)
+    np.save(opts.output, attrs)
+    print('Wrote attributes of %d files to %s' % (len(attrs), opts.output))
 
@@ -1,9 +1,11 @@
 from __future__ import print_function
+import argparse
 import sys
 import random
+import multiprocessing
 import numpy as np
 import itertools
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from sklearn import svm
 from sklearn import cross_validation
 import exerciseset as eset
@@ -27,6 +29,7 @@ default_svm_parameters = (
 )
 
 SvmResult = namedtuple('SvmResult', ['clf', 'train', 'test', 'score', 'params'])
+GridResult = namedtuple('GridResult', ['params', 'score', 'fold_scores'])
 
 def svm_parameters_comb(params):
     def prod(param):
@@ -51,17 +54,111 @@ def svm_models(svm_parameters, exerciseset, test_size=default_test_size):
     return [svm_model(data, target, params, test_size)
             for params in svm_parameters_comb(svm_parameters)]
 
+def fixed_splits(n, folds=None, test_size=default_test_size, seed=0):
+    """Train and test indices of n examples, shuffled with a fixed seed. Either k folds or a single split with
+    test_size of the examples in the test set."""
+    if folds is not None and folds < 2:
+        raise ValueError('At least 2 folds are needed, got %d' % folds)
+    order = np.random.RandomState(seed).permutation(n)
+    if folds is None:
+        n_test = int(np.ceil(test_size * n))
+        return [(order[n_test:], order[:n_test])]
+    parts = np.array_split(order, folds)
+    return [(np.concatenate(parts[:i] + parts[i+1:]), parts[i]) for i in xrange(folds)]
+
+def squared_distances(a, b):
+    d = np.sum(a**2, axis=1)[:,np.newaxis] + np.sum(b**2, axis=1)[np.newaxis,:] - 2 * np.dot(a, b.T)
+    return np.maximum(d, 0, out=d)
+
+def split_kernels(data, target, splits):
+    """Products and squared distances between the examples of every split, from which the kernels of all parameters
+    are derived. Rows are train or test examples, columns train examples."""
+    kernels = []
+    for train, test in splits:
+        d_train, d_test = data[train], data[test]
+        kernels.append({
+            'target': (target[train], target[test]),
+            'linear': (np.dot(d_train, d_train.T), np.dot(d_test, d_train.T)),
+            'sqdist': (squared_distances(d_train, d_train), squared_distances(d_test, d_train)),
+        })
+    return kernels
+
+def kernel_matrices(split, params):
+    if params['kernel'] == 'linear':
+        return split['linear']
+    if params['kernel'] == 'rbf':
+        return [np.exp(-params['gamma'] * d) for d in split['sqdist']]
+    raise ValueError('Kernel %s can not be precomputed' % params['kernel'])
+
+# Kernels of the splits of the running grid search. They are set before the pool is created and reach the workers only
+# because the pool forks them, which avoids pickling the kernels. Platforms spawning the workers are not supported.
+_split_kernels = None
+
+def evaluate_kernel(kernel_params, Cs):
+    """Score the kernel for all values of C, computing the kernel of every split once."""
+    scores = np.zeros((len(Cs), len(_split_kernels)))
+    for j, split in enumerate(_split_kernels):
+        k_train, k_test = kernel_matrices(split, kernel_params)
+        t_train, t_test = split['target']
+        for i, C in enumerate(Cs):
+            clf = svm.SVC(kernel='precomputed', C=C).fit(k_train, t_train)
+            scores[i, j] = clf.score(k_test, t_test)
+    return [GridResult(dict(kernel_params, C=C), s.mean(), s) for C, s in zip(Cs, scores)]
+
+def evaluate_kernel_star(args):
+    return evaluate_kernel(*args)
+
+def grid_search(svm_parameters, exerciseset, folds=None, test_size=default_test_size, processes=None, seed=0):
+    """Score all parameter combinations on the same fixed splits, see fixed_splits, in a pool of processes.
+
+    Kernels are derived from distances precomputed once per split and shared by all combinations. Returns a
+    GridResult with the mean score over the splits for every combination."""
+    global _split_kernels
+    data = exerciseset[:,1:]
+    target = exerciseset[:,0]
+    _split_kernels = split_kernels(data, target, fixed_splits(len(target), folds, test_size, seed))
+
+    # Combinations differing only in C share their kernel
+    kernels = OrderedDict()
+    for params in svm_parameters_comb(svm_parameters):
+        kernel_params = dict((k, v) for k, v in params.items() if k != 'C')
+        kernels.setdefault(tuple(sorted(kernel_params.items())), (kernel_params, []))[1].append(params['C'])
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(evaluate_kernel_star, kernels.values(), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _split_kernels = None
+    return list(itertools.chain(*results))
+
+def fold_count(value):
+    folds = int(value)
+    if folds < 2:
+        raise argparse.ArgumentTypeError('at least 2 folds are needed')
+    return folds
+
 if __name__ == '__main__':
-    opts = eset.create_arg_parser('Calculate SVM models for exercise set').parse_args()
+    p = eset.create_arg_parser('Calculate SVM models for exercise set')
+    p.add_argument('--folds', type=fold_count, default=None,
+            help='Number of folds to score every model on, by default a single split with test size %.2f' %
+                 default_test_size)
+    p.add_argument('--svm-processes', type=int, default=None,
+            help='Number of processes scoring SVM models, by default the number of cores')
+    opts = p.parse_args()
 
     print('Searching for CSV files on path: %s' % opts.directory)
     csvpaths = eset.find_csv_files(opts.directory)
 
     print('Extracting attributes')
-    exerciseset = eset.attributes_from_csvfiles(csvpaths, opts.features)
+    exerciseset = eset.attributes_from_csvfiles(csvpaths, opts.features, opts.cache, opts.processes)
 
-    print('Calculating SVM models with test size %.2f' % default_test_size)
-    all_models = svm_models(default_svm_parameters, exerciseset)
+    if opts.folds is not None:
+        print('Calculating SVM models with %d folds' % opts.folds)
+    else:
+        print('Calculating SVM models with test size %.2f' % default_test_size)
+    all_models = grid_search(default_svm_parameters, exerciseset, opts.folds, processes=opts.svm_processes)
     sorted_models = sorted(all_models, reverse=True, key=lambda x: x.score)[:model_count]
     average = sum([model.score for model in sorted_models]) / float(model_count)
 
@@ -69,4 +166,3 @@ if __name__ == '__main__':
         print('SVM score %f for params: %s' % (model.score, dict_format(model.params)))
 
     print('Average of the best %d models: %f' % (model_count, average))
-
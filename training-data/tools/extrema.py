@@ -1,6 +1,5 @@
 from __future__ import print_function
 import argparse
-from fractions import Fraction
 import scipy.signal as sig
 import itertools
 import numpy as np
@@ -13,15 +12,72 @@ default_smooth_conf = {'window_len': None, 'window': 'hanning'}
 def tswap(a):
     return a[1], a[0]
 
+# Normalized coefficients of the smoothing windows by (window, window length)
+_window_coefficients = {}
+
+def window_coefficients(window, window_len):
+    key = (window, window_len)
+    if key not in _window_coefficients:
+        if window == 'flat':  # moving average
+            w = np.ones(window_len, 'd')
+        else:
+            w = getattr(np, window)(window_len)
+        w = w / w.sum()
+        w.flags.writeable = False
+        _window_coefficients[key] = w
+    return _window_coefficients[key]
+
+# Windows shorter than this are convolved directly, longer ones using FFT, whose cost does not grow with the window
+fft_min_window_len = 300
+
+def smooth_backend(window_len):
+    return 'fft' if window_len >= fft_min_window_len else 'direct'
+
+# Bound of the rounding errors of fftconvolve relative to the largest magnitude of the signals, with a wide margin.
+# All signals are transformed together, so the errors of every signal scale with the largest of them
+fft_relative_error = 1e-9
+
+def snap_ties(y, rows, w):
+    """Recompute the FFT smoothed rows y exactly where neighbouring samples are closer than the rounding errors of FFT.
+
+    All other neighbours differ by more than their combined errors, so every comparison of neighbouring samples, and
+    with it every extremum, is the same as for the direct convolution."""
+    window_len = w.shape[0]
+    tolerance = fft_relative_error * np.abs(rows).max()
+    near = np.abs(np.diff(y, axis=-1)) <= 2 * tolerance
+    ties = np.zeros(y.shape, dtype=bool)
+    ties[:, :-1] |= near
+    ties[:, 1:] |= near
+    # np.dot with the reversed window sums in the same order as np.convolve
+    reversed_w = w[::-1].copy()
+    for r, i in zip(*np.nonzero(ties)):
+        y[r, i] = np.dot(rows[r, i:i + window_len], reversed_w)
+    return y
+
 def smooth(x, window_len, window):
     """Smooth function from SciPy cookbook: http://wiki.scipy.org/Cookbook/SignalSmooth"""
-    if window_len is None:
-        window_len = x.size / 10
-
     if x.ndim != 1:
         raise ValueError, "smooth only accepts 1 dimension arrays."
 
-    if x.size < window_len:
+    return smooth_signals(x, window_len, window)
+
+def smooth_signals(x, window_len=None, window='hanning', backend=None):
+    """Smooth every signal along the last axis of x, e.g. the axes of a `(3, N)` array or of a `(B, 3, N)` batch, like
+    `smooth`.
+
+    The backend is one of
+    - 'direct': np.convolve of every signal in turn, giving exactly the results of `smooth`.
+    - 'fft': fftconvolve, whose cost does not grow with the window length. Its results deviate by rounding errors,
+      except for neighbouring samples that are about equal, which are recomputed directly (see `snap_ties`). The
+      extrema of the smoothed signals are therefore exactly those of 'direct'.
+    - 'lfilter': filters all signals in one call. Its results matched 'direct' exactly on the labelled data.
+    By default the backend is picked by the window length, see `smooth_backend`."""
+    x = np.asarray(x)
+    size = x.shape[-1]
+    if window_len is None:
+        window_len = size // 10
+
+    if size < window_len:
         raise ValueError, "Input vector needs to be bigger than window size."
 
     if window_len < 3:
@@ -30,15 +86,22 @@ def smooth(x, window_len, window):
     if not window in smooth_windows:
         raise ValueError, ("Window is non of %s" % ", ".join(smooth_windows))
 
+    # Reflect the signals at their ends, the result is longer than the signals by window_len - 1
+    s = np.concatenate((x[..., window_len-1:0:-1], x, x[..., :-window_len:-1]), axis=-1)
+    rows = s.reshape((-1, s.shape[-1]))
+    w = window_coefficients(window, window_len)
+    backend = backend or smooth_backend(window_len)
 
-    s = np.r_[x[window_len-1:0:-1], x, x[-1:-window_len:-1]]
-    if window == 'flat':  # moving average
-        w = np.ones(window_len, 'd')
+    if backend == 'direct':
+        # One np.convolve per signal, batched alternatives sum in a different order and differ in the last bits
+        y = np.array([np.convolve(w, row, mode='valid') for row in rows])
+    elif backend == 'fft':
+        y = snap_ties(sig.fftconvolve(rows, w[np.newaxis, :], mode='valid'), rows, w)
+    elif backend == 'lfilter':
+        y = sig.lfilter(w, 1.0, rows, axis=-1)[:, window_len-1:]
     else:
-        w = getattr(np, window)(window_len)
-
-    y = np.convolve(w/w.sum(), s, mode='valid')
-    return y
+        raise ValueError, "Unknown smoothing backend %s" % backend
+    return y.reshape(x.shape[:-1] + (y.shape[-1],))
 
 def extrema(arr, smoothconf):
     arr_smooth = smooth(arr, **smoothconf)
@@ -46,48 +109,65 @@ def extrema(arr, smoothconf):
     minima = sig.argrelmin(arr_smooth)[0]
     return maxima, minima
 
-def find_window(arr, v):
-    size = arr.shape[0]
+def extrema_of_signals(arr, smoothconf):
+    """Maxima and minima of every signal, smoothing all of them at once."""
+    return [(sig.argrelmax(s)[0], sig.argrelmin(s)[0]) for s in smooth_signals(arr, **smoothconf)]
+
+def find_window(arr, v, lo=0, hi=None):
+    """Windows around the values v, reaching a quarter of the way to the closest elements of the sorted arr below and
+    above each value. Returns the distances of the window bounds from the values.
+
+    lo and hi limit the elements used for each value to `arr[lo:hi]`, which allows to search several sorted arrays
+    at once, once they are concatenated with their values made disjoint."""
+    v = np.asarray(v)
+    hi = arr.shape[0] if hi is None else hi
     scaler = 0.25
 
     # Find closest index and value matching v
-    closest_index = np.searchsorted(arr, v)
-    closest_index = closest_index if closest_index < size else size - 1
+    closest_index = np.minimum(np.searchsorted(arr, v), hi - 1)
     closest = arr[closest_index]
 
-    # Attempt to find indexes and values surrounding v
-    prev_index, next_index = (closest_index - 1, closest_index) if v < closest else (closest_index, closest_index + 1)
-    prev = arr[prev_index] if prev_index >= 0 else None
-    next_ = arr[next_index] if next_index < size else None
+    # Indexes surrounding v
+    prev_index = closest_index - (v < closest)
+    next_index = prev_index + 1
+    prev = arr[np.maximum(prev_index, lo)]
+    next_ = arr[np.minimum(next_index, hi - 1)]
 
     # Adjust surrounding values on edge cases
-    if prev_index < 0:
-        prev = v - (next_ - v)
-
-    if next_index >= size:
-        next_ = v + (v - prev)
+    prev = np.where(prev_index < lo, v - (next_ - v), prev)
+    next_ = np.where(next_index >= hi, v + (v - prev), next_)
 
     return (v - prev) * scaler, (next_ - v) * scaler
 
-def has_between(arr, low, high):
-    low_i, high_i = np.searchsorted(arr, [low, high])
-    for closest in arr[low_i-1:high_i+1]:
-        if low < closest < high:
-            return True
-    return False
+def has_between(arr, low, high, lo=0, hi=None):
+    """Whether the sorted arr has an element strictly between low and high, for all bounds at once. lo and hi limit
+    the elements searched like in `find_window`."""
+    hi = arr.shape[0] if hi is None else hi
+    low_index = np.searchsorted(arr, low)
+    high_index = np.searchsorted(arr, high)
+    between = high_index > np.searchsorted(arr, low, side='right')
+
+    # Windows starting below the first element have always been tested against the last element only, as the scanned
+    # slice arr[low_index - 1:high_index + 1] then starts at index -1. Kept to not change the features.
+    last = arr[np.clip(hi - 1, 0, max(arr.shape[0] - 1, 0))] if arr.shape[0] else np.zeros_like(high)
+    between_last = (hi > lo) & (high_index >= hi - 1) & (low < last) & (last < high)
+    return np.where(low_index == lo, between_last, between)
+
+def matching_values_count(source, window_source, target):
+    left, right = find_window(window_source, source)
+    return int(np.count_nonzero(has_between(target, source - left, source + right)))
 
 def matching_values_ratio(source, window_source, target):
-    counter = 0
-    for v in source:
-        left, right = find_window(window_source, v)
-        if has_between(target, v - left, v + right):
-            counter += 1
-    return Fraction(counter, source.shape[0])
+    return matching_values_count(source, window_source, target) / float(source.shape[0])
+
+def mean_ratio(count1, size1, count2, size2):
+    # Exactly the rounded mean of both ratios, as it is computed on integers
+    return float(count1 * size2 + count2 * size1) / (2 * size1 * size2)
 
 def matching_values_mean(first, second):
-    n1 = matching_values_ratio(first[0], first[1], second[0])
-    n2 = matching_values_ratio(second[0], second[1], first[0])
-    return (n1 + n2) / 2
+    n1 = matching_values_count(first[0], first[1], second[0])
+    n2 = matching_values_count(second[0], second[1], first[0])
+    return mean_ratio(n1, first[0].shape[0], n2, second[0].shape[0])
 
 def matching_values_all_combinations(first, second):
     combs = [
@@ -103,20 +183,64 @@ def matching_values_all_combinations(first, second):
 
 arr_index_combinations = [(0, 1), (0, 2), (1, 2)]
 
+# Kinds of extrema (0 maxima, 1 minima) compared by each combination of matching_values_all_combinations
+extrema_kind_combinations = [('max to max', 0, 0), ('min to max', 1, 0), ('max to min', 0, 1), ('min to min', 1, 1)]
+
+def matching_counts(ex):
+    """Match the extrema of all axes with each other at once.
+
+    ex contains the maxima and minima of every axis. Returns `counts[a, k, b, l]`, the number of extrema of kind k
+    (0 maxima, 1 minima) of axis a matching extrema of kind l of axis b as in `matching_values_count`, and the number
+    of extrema `sizes[a, k]`."""
+    segments = [e for maxima_minima in ex for e in maxima_minima]
+    num_segments = len(segments)
+    sizes = np.array([s.shape[0] for s in segments])
+    if not sizes.all():
+        raise ValueError("Every axis needs maxima and minima to match extrema")
+
+    # Offset the segments so that they, and the windows around their values, cover disjoint ranges. All segments are
+    # then searched at once in their concatenation.
+    span = 2 * (max(s.max() for s in segments) + 1)
+    offsets = np.arange(num_segments) * span
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    segment = np.repeat(np.arange(num_segments), sizes)
+    values = np.concatenate(segments) + offsets[segment]
+
+    # The window around a maximum is found using the minima of the same axis and vice versa
+    window_segments = np.arange(num_segments) ^ 1
+    window_ends = np.cumsum(sizes[window_segments])
+    window_starts = window_ends - sizes[window_segments]
+    window_values = np.concatenate([segments[w] + offsets[s] for s, w in enumerate(window_segments)])
+    left, right = find_window(window_values, values, window_starts[segment], window_ends[segment])
+
+    # Test the window around every extremum against every segment
+    low = (values - left - offsets[segment])[:, np.newaxis] + offsets
+    high = (values + right - offsets[segment])[:, np.newaxis] + offsets
+    matching = has_between(values, low, high, starts, ends)
+    counts = np.add.reduceat(matching.astype(int), starts, axis=0)
+
+    num_axes = num_segments // 2
+    return counts.reshape((num_axes, 2, num_axes, 2)), sizes.reshape((num_axes, 2))
+
 def matching_extrema(arr, smoothconf=None):
     smconf = {}
     smconf.update(default_smooth_conf)
     smconf.update(smoothconf or {})
-    ex = [extrema(a, smconf) for a in arr]
+    ex = extrema_of_signals(np.vstack(arr), smconf)
+    counts, sizes = matching_counts(ex)
     return [
-        ((a, b), matching_values_all_combinations(ex[a], ex[b]))
+        ((a, b), [
+            (l, mean_ratio(counts[a, k, b, m], sizes[a, k], counts[b, m, a, k], sizes[b, m]))
+            for l, k, m in extrema_kind_combinations
+        ])
         for a, b in arr_index_combinations
     ]
 
 def matching_extrema_flat(arr, smoothconf=None):
     matches = matching_extrema(arr, smoothconf)
     vs = itertools.chain(*(v for _, v in matches))
-    return (float(v) for _, v in vs)
+    return (v for _, v in vs)
 
 def create_arg_parser():
     p = argparse.ArgumentParser(description='Calculate matching extrema')
@@ -0,0 +1,130 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+import exerciseset as eset
+import extrema
+
+all_rolling_features = ('mean', 'std', 'min', 'max', 'extrema')
+
+def window_starts(lengths, window_len, step=1):
+    """Index of the signal and start offset within the signal of every window, for signals of the given lengths.
+    Signals shorter than the window have no windows."""
+    starts = [np.arange(0, n - window_len + 1, step) for n in lengths]
+    indexes = [np.repeat(i, len(s)) for i, s in enumerate(starts)]
+    return np.concatenate(indexes).astype(int), np.concatenate(starts).astype(int)
+
+def window_sums(x, window_len, starts):
+    """Sums along the last axis of x over the windows starting at starts, taken from the cumulative sums."""
+    cumsum = np.zeros(x.shape[:-1] + (x.shape[-1] + 1,), dtype=x.dtype)
+    np.cumsum(x, axis=-1, out=cumsum[..., 1:])
+    return cumsum[..., starts + window_len] - cumsum[..., starts]
+
+def rolling_mean_std(x, window_len, starts):
+    if np.issubdtype(x.dtype, np.integer):
+        # Integer sums are exact, so the variance does not suffer from cancellation
+        center = 0
+        x = x.astype(np.int64)
+    else:
+        center = x.mean(axis=-1)[..., np.newaxis]
+        x = x - center
+    sums = window_sums(x, window_len, starts)
+    squares = window_sums(x * x, window_len, starts)
+    mean = sums / float(window_len) + center
+    var = (squares * window_len - sums * sums) / float(window_len * window_len)
+    return mean, np.sqrt(np.maximum(var, 0))
+
+def rolling_extreme(x, window_len, starts, func):
+    """Maximum (func np.maximum) or minimum (np.minimum) over the windows, using prefix and suffix extremes of blocks
+    of the window length (van Herk / Gil-Werman), which takes O(N) for any window length."""
+    n = x.shape[-1]
+    blocks = -(-n // window_len)
+    padded = np.concatenate([x, np.repeat(x[..., -1:], blocks * window_len - n, axis=-1)], axis=-1)
+    b = padded.reshape(x.shape[:-1] + (blocks, window_len))
+    prefix = func.accumulate(b, axis=-1).reshape(padded.shape)
+    suffix = func.accumulate(b[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+    return func(suffix[..., starts], prefix[..., starts + window_len - 1])
+
+def extrema_indicators(signals, smoothconf=None):
+    """Local maxima and minima of every sample of the concatenated signals, as in extrema.extrema. With a smoothconf
+    the signals are smoothed first, the smoothed samples aligned with the samples of the signals. The first and last
+    sample of a signal are never extrema."""
+    maxima = []
+    minima = []
+    for signal in signals:
+        n = signal.shape[-1]
+        if smoothconf is not None:
+            smoothed = extrema.smooth_signals(signal, **smoothconf)
+            shift = (smoothed.shape[-1] - n) // 2
+            signal = smoothed[..., shift:shift + n]
+        inner = signal[..., 1:-1]
+        is_max = np.zeros(signal.shape, dtype=bool)
+        is_min = np.zeros(signal.shape, dtype=bool)
+        is_max[..., 1:-1] = (inner > signal[..., :-2]) & (inner > signal[..., 2:])
+        is_min[..., 1:-1] = (inner < signal[..., :-2]) & (inner < signal[..., 2:])
+        maxima.append(is_max)
+        minima.append(is_min)
+    return np.concatenate(maxima, axis=-1), np.concatenate(minima, axis=-1)
+
+def rolling_features(signals, window_len, step=1, features=all_rolling_features, smoothconf=None):
+    """Features of all windows of the signals, computed for all windows at once.
+
+    Signals are a (3, N) array, a (B, 3, N) batch or a list of (3, N) arrays of different lengths. For every window
+    there is a row of features: per axis the scaled mean and std, as exerciseset.means and exerciseset.stds compute
+    them for whole files, the minimum and maximum scaled like the mean, and the number of maxima and minima. Like
+    extrema.extrema on a single window, the first and last sample of a window are never counted as extrema. Returns
+    the features, the index of the signal of every window and the start offsets of the windows in their signals."""
+    if isinstance(signals, np.ndarray) and signals.ndim == 2:
+        signals = [signals]
+    if len(signals) == 0:
+        num_columns = sum(6 if f == 'extrema' else 3 for f in features)
+        return np.zeros((0, num_columns)), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    lengths = [s.shape[-1] for s in signals]
+    indexes, starts = window_starts(lengths, window_len, step)
+
+    # Windows never cross the end of a signal, so all signals are handled as one
+    x = np.concatenate(list(signals), axis=-1)
+    offsets = np.cumsum([0] + lengths[:-1])
+    positions = offsets[indexes] + starts
+
+    columns = []
+    if 'mean' in features or 'std' in features:
+        mean, std = rolling_mean_std(x, window_len, positions)
+        if 'mean' in features:
+            columns.append(eset.scale(mean, eset.min_mean, eset.max_mean))
+        if 'std' in features:
+            columns.append(eset.scale(std, eset.min_std, eset.max_std))
+    for name, func in [('min', np.minimum), ('max', np.maximum)]:
+        if name in features:
+            extreme = rolling_extreme(x, window_len, positions, func).astype(float)
+            columns.append(eset.scale(extreme, eset.min_mean, eset.max_mean))
+    if 'extrema' in features:
+        maxima, minima = extrema_indicators(signals, smoothconf)
+        # Only the inner samples of a window have both neighbours within the window
+        inner_len = max(window_len - 2, 0)
+        columns.append(window_sums(maxima.astype(int), inner_len, positions + 1))
+        columns.append(window_sums(minima.astype(int), inner_len, positions + 1))
+
+    attrs = np.vstack(columns).T if columns else np.zeros((len(starts), 0))
+    return attrs, indexes, starts
+
+def create_arg_parser():
+    p = argparse.ArgumentParser(description='Calculate features of sliding windows over exercise sessions')
+    p.add_argument('directory', metavar='DIR', type=str, help='Directory to scan CSV from')
+    p.add_argument('--window', type=int, default=400, help='Length of the windows')
+    p.add_argument('--step', type=int, default=10, help='Offset between the starts of consecutive windows')
+    p.add_argument('--features', nargs='+', choices=all_rolling_features, type=str,
+            default=all_rolling_features, help='Features to include in the result')
+    p.add_argument('--smoothlen', type=int, default=None, help='Length of the smoothing window for extrema')
+    p.add_argument('--output', metavar='FILE', type=str, default='rollingfeatures.npz',
+            help='File to write the features, signal indexes, window starts and file names to')
+    return p
+
+if __name__ == '__main__':
+    opts = create_arg_parser().parse_args()
+    filenames = sorted(eset.find_csv_files(opts.directory))
+    signals = [np.vstack(eset.xyz_arrays(eset.data_from_csv(f))) for f in filenames]
+    smoothconf = {'window_len': opts.smoothlen, 'window': 'hanning'} if opts.smoothlen else None
+
+    attrs, indexes, starts = rolling_features(signals, opts.window, opts.step, opts.features, smoothconf)
+    np.savez(opts.output, features=attrs, indexes=indexes, starts=starts, filenames=filenames)
+    print('Wrote features of %d windows of %d files to %s' % (len(starts), len(filenames), opts.output))